@@ -11,6 +11,9 @@ from yaml import FullLoader
 from lopocs.app import api
 from lopocs.database import Session
 from lopocs.stats import Stats
+from lopocs.cache import TileCache, TilesetCache, HierarchyCache
+from lopocs.workers import LazWorkers
+from lopocs.prefetch import Prefetcher
 from lopocs.conf import Config
 
 # lopocs version
@@ -58,4 +61,23 @@ def create_app(env='Defaults'):
     if Config.STATS:
         Stats.init()
 
+    if Config.TILE_CACHE_SIZE:
+        TileCache.init(Config.TILE_CACHE_SIZE)
+
+    if Config.TILESET_CACHE_SIZE:
+        TilesetCache.init(Config.TILESET_CACHE_SIZE)
+
+    HierarchyCache.init(Config.CACHE_DIR, Config.HIERARCHY_CACHE_SIZE,
+                        Config.HIERARCHY_CACHE_DISK_SIZE)
+
+    if Config.PREFETCH_WORKERS:
+        # prefetched nodes are kept in the tile cache
+        if not Config.TILE_CACHE_SIZE:
+            app.logger.warning('PREFETCH_WORKERS needs a TILE_CACHE_SIZE')
+        Prefetcher.init(Config.PREFETCH_WORKERS,
+                        Config.PREFETCH_MIN_CONNECTIONS)
+
+    if Config.LAZ_COMPRESSION == 'app' or Config.CESIUM_LAZ_TRANSPORT:
+        LazWorkers.init(Config.LAZ_WORKERS)
+
     return app
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio server used by ``lopocs serve --async``.
+
+Greyhound and 3D Tiles reads query the database with asyncpg, so a single
+process keeps many tile requests open while waiting for postgres, and
+decode/encode points in a pool of threads. Other requests are less frequent
+and run the flask implementation in a thread.
+
+Needs the ``async`` extra: ``pip install lopocs[async]``.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+import asyncpg
+from aiohttp import web
+from flask import Response as FlaskResponse
+
+from . import create_app, greyhound, threedtiles
+from .app import metrics
+from .cache import TileCache
+from .conf import Config
+from .database import Session, LopocsException
+from .pool import PoolTimeout
+from .utils import list_from_str, pg_placeholders
+
+
+class AsyncSingleFlight():
+    """
+    Coalesce concurrent calls of a coroutine sharing the same key: the
+    first caller starts a task that the others await.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._inflight = {}
+
+    async def do(self, key, func, *args):
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(func(*args))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        # a client going away must not cancel the read of the others
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'inflight': len(self._inflight),
+        }
+
+
+greyhound_flights = AsyncSingleFlight()
+threedtiles_flights = AsyncSingleFlight()
+
+
+class AioSession():
+    """
+    asyncpg pool used to read patches, and threads used to decode them
+    """
+    pool = None
+    timeout = 30
+    executor = None
+
+    @classmethod
+    async def init(cls, config):
+        cls.timeout = config.get('PG_POOL_TIMEOUT', 30)
+        server_settings = {}
+        if config.get('PG_STATEMENT_TIMEOUT'):
+            server_settings['statement_timeout'] = str(
+                int(config['PG_STATEMENT_TIMEOUT']))
+        cls.pool = await asyncpg.create_pool(
+            Session.dsn,
+            min_size=config.get('PG_POOL_MIN', 1),
+            max_size=config.get('PG_POOL_MAX', cpu_count()),
+            server_settings=server_settings)
+        cls.executor = ThreadPoolExecutor(cpu_count())
+
+    @classmethod
+    async def close(cls):
+        await cls.pool.close()
+        cls.executor.shutdown(wait=False)
+
+    @classmethod
+    async def query_patch(cls, query, parameters):
+        """Performs a query returning a single pcpatch and returns it as
+        raw wkb
+        """
+        # pcpatch has no binary output function, go through bytea
+        sql = (
+            "select decode(patch::text, 'hex') from ({}) as _patches(patch)"
+            .format(query.strip().rstrip(';'))
+        )
+        try:
+            async with cls.pool.acquire(timeout=cls.timeout) as conn:
+                return await conn.fetchval(pg_placeholders(sql), *parameters)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(
+                'no connection available after {}s'.format(cls.timeout))
+
+    @classmethod
+    async def run(cls, func, *args):
+        '''
+        Run CPU bound work in the thread pool
+        '''
+        return await asyncio.get_event_loop().run_in_executor(
+            cls.executor, func, *args)
+
+    @classmethod
+    def stats(cls):
+        return {
+            'size': cls.pool.get_size(),
+            'maxconn': cls.pool.get_max_size(),
+            'idle': cls.pool.get_idle_size(),
+        }
+
+
+async def in_thread(func, *args):
+    '''
+    Run blocking code (psycopg2 queries) in the default executor
+    '''
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+def query_arg(request, name, type=str, required=False):
+    '''
+    Returns the query string argument 'name' converted with 'type'
+    '''
+    value = request.query.get(name)
+    if value is None:
+        if required:
+            raise web.HTTPBadRequest(text='missing argument {}'.format(name))
+        return None
+    if type is bool:
+        return value.lower() not in ('', '0', 'false')
+    try:
+        return type(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text='invalid argument {}'.format(name))
+
+
+def validate_resource(request):
+    '''Resource is a table name with schema and column name combined as
+    follow : schema.table.column
+    '''
+    resource = request.match_info['resource']
+    if resource.count('.') != 2:
+        raise web.HTTPNotFound(
+            text="resource must be in the form schema.table.column")
+
+    table = resource[:resource.rfind('.')]
+    column = resource.split('.')[-1]
+    return table, column
+
+
+async def call_sync(request, func, *args):
+    '''
+    Run a request handler of the flask application in a thread and
+    convert its result
+    '''
+    flask_app = request.app['flask']
+
+    def call():
+        with flask_app.app_context():
+            result = func(*args)
+            if isinstance(result, FlaskResponse):
+                return web.Response(
+                    body=result.get_data(), status=result.status_code,
+                    content_type=result.mimetype)
+        return web.json_response(result)
+
+    return await in_thread(call)
+
+
+@web.middleware
+async def errors(request, handler):
+    try:
+        return await handler(request)
+    except PoolTimeout as error:
+        # database overloaded, clients may retry later
+        return web.json_response({'message': str(error)}, status=503)
+    except LopocsException as error:
+        return web.json_response({'message': str(error)}, status=404)
+
+
+async def allow_cors(request, response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+
+
+# infos
+
+async def infos_global(request):
+    return web.json_response("Light OpenSource PointCloud Server by Oslandia")
+
+
+async def infos_contact(request):
+    return web.json_response("infos+li3ds@oslandia.com")
+
+
+async def infos_online(request):
+    return web.json_response("Congratulation, LOPoCS is online!!!")
+
+
+async def infos_sources(request):
+    await in_thread(Session.refresh_catalog)
+    return web.json_response([
+        values.asjson() for values in Session.catalog.values()
+    ])
+
+
+async def infos_metrics(request):
+    counters = await in_thread(metrics)
+    counters['aio'] = {
+        'pool': AioSession.stats(),
+        'single_flight': {
+            'greyhound_read': greyhound_flights.stats(),
+            '3dtiles_read': threedtiles_flights.stats(),
+        },
+    }
+    return web.json_response(counters)
+
+
+# greyhound
+
+async def greyhound_info(request):
+    table, column = validate_resource(request)
+    return await call_sync(request, greyhound.GreyhoundInfo, table, column)
+
+
+def greyhound_request(table, column, *args):
+    session = Session(table, column)
+    return (session,) + tuple(greyhound.read_parameters(session, *args))
+
+
+async def greyhound_read(request):
+    table, column = validate_resource(request)
+    compress = query_arg(request, 'compress', bool)
+    session, bbox, output, lod = await in_thread(
+        greyhound_request, table, column,
+        query_arg(request, 'offset'),
+        query_arg(request, 'scale', float),
+        query_arg(request, 'bounds'),
+        query_arg(request, 'depth', int),
+        query_arg(request, 'depthBegin', int),
+        query_arg(request, 'depthEnd', int),
+        query_arg(request, 'schema'))
+
+    t0 = time.time()
+    key = greyhound.tile_key(session, bbox, output, lod, compress)
+    cached = greyhound.cached_points(key)
+    if cached:
+        [read, npoints] = cached
+    else:
+        [read, npoints] = await greyhound_flights.do(
+            key, greyhound_points, key, session, bbox, output, lod, compress)
+
+    if Config.STATS:
+        # redis is queried synchronously
+        await in_thread(greyhound.record_stats, t0, npoints)
+
+    if greyhound.prefetching():
+        asyncio.get_event_loop().run_in_executor(
+            None, greyhound.prefetch_children,
+            session, bbox, output, lod, compress)
+
+    return web.Response(body=bytes(read), content_type='application/octet-stream')
+
+
+async def greyhound_points(key, session, bbox, output, lod, compress):
+    sql, parameters = greyhound.points_query(session, bbox, output, lod, compress)
+    if Config.DEBUG:
+        print(sql, parameters)
+
+    pcpatch_wkb = await AioSession.query_patch(sql, parameters)
+
+    result = await AioSession.run(
+        greyhound.read_points, session, pcpatch_wkb, output, lod, compress)
+    TileCache.put(key, result)
+    return result
+
+
+async def greyhound_hierarchy(request):
+    table, column = validate_resource(request)
+    return await call_sync(
+        request, greyhound.GreyhoundHierarchy, table, column,
+        query_arg(request, 'bounds', required=True),
+        query_arg(request, 'depthBegin', int),
+        query_arg(request, 'depthEnd', int),
+        query_arg(request, 'scale', float),
+        query_arg(request, 'offset'))
+
+
+# 3dtiles
+
+async def threedtiles_info(request):
+    table, column = validate_resource(request)
+    return await call_sync(request, threedtiles.ThreeDTilesInfo, table, column)
+
+
+def threedtiles_request(table, column, box, lod):
+    session = Session(table, column)
+    return (session,) + tuple(threedtiles.sql_query(session, box, lod))
+
+
+async def threedtiles_read(request):
+    table, column = validate_resource(request)
+    box = list_from_str(query_arg(request, 'bounds', required=True))
+    lod = query_arg(request, 'lod', int, required=True)
+    key = (table, column, tuple(round(b, 6) for b in box), lod)
+    tile = await threedtiles_flights.do(
+        key, threedtiles_tile, table, column, box, lod)
+    return web.Response(body=bytes(tile), content_type='application/octet-stream')
+
+
+async def threedtiles_tile(table, column, box, lod):
+    session, sql, parameters = await in_thread(
+        threedtiles_request, table, column, box, lod)
+    if Config.DEBUG:
+        print(sql, parameters)
+
+    pcpatch_wkb = await AioSession.query_patch(sql, parameters)
+    return await AioSession.run(threedtiles.encode_tile, session, pcpatch_wkb)
+
+
+async def threedtiles_tileset(request):
+    table, column = validate_resource(request)
+    return await call_sync(
+        request, threedtiles.ThreeDTilesTileset, table, column,
+        query_arg(request, 'bounds'),
+        query_arg(request, 'lod', int))
+
+
+async def on_startup(app):
+    await AioSession.init(app['flask'].config)
+
+
+async def on_cleanup(app):
+    await AioSession.close()
+
+
+def create_aio_app():
+    '''
+    Creates the aiohttp application, the flask application is created
+    as well to load the configuration and serve the other requests
+    '''
+    flask_app = create_app()
+    prefix = flask_app.config.get('URL_PREFIX', '').rstrip('/')
+
+    app = web.Application(middlewares=[errors])
+    app['flask'] = flask_app
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.on_response_prepare.append(allow_cors)
+
+    routes = (
+        ('/infos/global', infos_global),
+        ('/infos/contact', infos_contact),
+        ('/infos/online', infos_online),
+        ('/infos/sources', infos_sources),
+        ('/infos/metrics', infos_metrics),
+        ('/greyhound/{resource}/info', greyhound_info),
+        ('/greyhound/{resource}/read', greyhound_read),
+        ('/greyhound/{resource}/hierarchy', greyhound_hierarchy),
+        ('/3dtiles/{resource}/info', threedtiles_info),
+        ('/3dtiles/{resource}/read.pnts', threedtiles_read),
+        ('/3dtiles/{resource}/tileset.json', threedtiles_tileset),
+    )
+    for path, handler in routes:
+        app.router.add_get(prefix + path, handler)
+    return app
+
+
+def serve(host, port):
+    web.run_app(create_aio_app(), host=host, port=port)
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 from flask_restplus import Api, Resource, reqparse
 
+from . import greyhound, threedtiles
 from .greyhound import GreyhoundInfo, GreyhoundRead, GreyhoundHierarchy
-from .threedtiles import ThreeDTilesInfo, ThreeDTilesRead
-from .database import Session
+from .threedtiles import ThreeDTilesInfo, ThreeDTilesRead, ThreeDTilesTileset
+from .database import Session, CatalogListener
+from .pool import PoolTimeout
+from .cache import TileCache, TilesetCache, HierarchyCache
+from .prefetch import Prefetcher
 
 api = Api(
     version='0.1',
@@ -12,6 +16,12 @@ api = Api(
 )
 
 
+@api.errorhandler(PoolTimeout)
+def handle_pool_timeout(error):
+    '''Database overloaded, clients may retry later'''
+    return {'message': str(error)}, 503
+
+
 # global namespace
 gns = api.namespace('infos', description='Information about LOPoCS')
 
@@ -43,8 +53,7 @@ class Sources(Resource):
     def get(self):
         """List available resources
         """
-        Session.clear_catalog()
-        Session.fill_catalog()
+        Session.refresh_catalog()
         resp = [
             values.asjson()
             for key, values in Session.catalog.items()
@@ -52,6 +61,38 @@ class Sources(Resource):
         return resp
 
 
+def metrics():
+    '''
+    Internal counters of this worker
+    '''
+    return {
+        'tile_cache': TileCache.stats(),
+        'tileset_cache': TilesetCache.stats(),
+        'hierarchy_cache': HierarchyCache.stats(),
+        'prefetch': Prefetcher.stats(),
+        'pool': Session.pool.stats(),
+        'catalog': {
+            'generation': Session.generation,
+            'listening': CatalogListener.listening,
+        },
+        'single_flight': {
+            'greyhound_read': greyhound.read_flights.stats(),
+            'greyhound_hierarchy': greyhound.hierarchy_flights.stats(),
+            '3dtiles_read': threedtiles.read_flights.stats(),
+            '3dtiles_tileset': threedtiles.tileset_flights.stats(),
+        },
+    }
+
+
+@gns.route("/metrics")
+class Metrics(Resource):
+
+    def get(self):
+        """Internal counters of this worker
+        """
+        return metrics()
+
+
 # Greyhound namespace
 ghd_ns = api.namespace('greyhound', description='Greyhound protocol')
 
@@ -158,3 +199,22 @@ class ThreeDTilesReadRoute(Resource):
             args.get('bounds'),
             args.get('lod')
         )
+
+
+threedtiles_tileset = reqparse.RequestParser()
+threedtiles_tileset.add_argument('bounds', type=str, required=False)
+threedtiles_tileset.add_argument('lod', type=int, required=False)
+
+
+@threedtiles_ns.route("/<resource>/tileset.json")
+class ThreeDTilesTilesetRoute(Resource):
+
+    @threedtiles_ns.expect(threedtiles_tileset, validate=True)
+    def get(self, resource):
+        table, column = validate_resource(resource)
+        args = threedtiles_tileset.parse_args()
+        return ThreeDTilesTileset(
+            table, column,
+            args.get('bounds'),
+            args.get('lod')
+        )
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+
+from .octree import encode_hierarchy, decode_hierarchy
+
+
+class LRUCache():
+    """
+    Thread safe least recently used cache bounded by the total size in bytes
+    of the values it contains.
+
+    Values must support ``len()`` or a ``sizeof`` callable must be given.
+    """
+
+    def __init__(self, maxbytes, sizeof=len):
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.maxbytes:
+            # would evict everything and still not fit
+            return False
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                _, (_, oldsize) = self._items.popitem(last=False)
+                self.nbytes -= oldsize
+                self.evictions += 1
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._items.pop(key)
+            except KeyError:
+                return default
+            self.nbytes -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._items),
+            'bytes': self.nbytes,
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class TileCache():
+    """
+    Process wide cache for points returned by read requests.
+
+    Keys are built by the caller and look like
+    (table, column, pcid, bounds, lod, compress)
+    """
+    cache = None
+
+    @classmethod
+    def init(cls, maxbytes):
+        cls.cache = LRUCache(maxbytes, sizeof=lambda value: len(value[0]))
+
+    @classmethod
+    def enabled(cls):
+        return cls.cache is not None
+
+    @classmethod
+    def get(cls, key):
+        if cls.cache is None:
+            return None
+        return cls.cache.get(key)
+
+    @classmethod
+    def contains(cls, key):
+        return cls.cache is not None and key in cls.cache
+
+    @classmethod
+    def put(cls, key, value):
+        if cls.cache is None:
+            return False
+        return cls.cache.put(key, value)
+
+    @classmethod
+    def stats(cls):
+        if cls.cache is None:
+            return {}
+        return cls.cache.stats()
+
+
+class TilesetCache(TileCache):
+    """
+    Process wide cache for the tilesets served by the tileset.json route,
+    stored as encoded json.
+    """
+    cache = None
+
+    @classmethod
+    def init(cls, maxbytes):
+        cls.cache = LRUCache(maxbytes)
+
+
+class HierarchyCache():
+    """
+    Two level cache for computed Greyhound hierarchies: encoded hierarchies
+    are kept in an in-process LRU in front of a directory of files.
+
+    Files are written atomically and the directory is capped to
+    ``disk_maxbytes`` (0 for no limit) by removing the least recently used
+    files first.
+    """
+    suffix = '.hcyb'
+    memory = None
+    directory = None
+    disk_maxbytes = 0
+    disk_hits = 0
+    disk_misses = 0
+    disk_evictions = 0
+    _lock = Lock()
+
+    @classmethod
+    def init(cls, directory, memory_maxbytes, disk_maxbytes=0):
+        cls.directory = directory
+        cls.memory = LRUCache(memory_maxbytes)
+        cls.disk_maxbytes = disk_maxbytes
+        cls.disk_hits = cls.disk_misses = cls.disk_evictions = 0
+
+    @classmethod
+    def enabled(cls):
+        return cls.memory is not None
+
+    @staticmethod
+    def key(*args):
+        '''
+        Short hash of the request parameters identifying a hierarchy
+        '''
+        return sha1(repr(args).encode()).hexdigest()[:20]
+
+    @classmethod
+    def path(cls, key):
+        return os.path.join(cls.directory, key + cls.suffix)
+
+    @classmethod
+    def get(cls, key):
+        '''
+        Returns the hierarchy stored under 'key', None if not found
+        '''
+        if cls.memory is None:
+            return None
+        data = cls.memory.get(key)
+        if data is None:
+            data = cls._read(key)
+            if data is None:
+                return None
+            cls.memory.put(key, data)
+        return decode_hierarchy(data)
+
+    @classmethod
+    def put(cls, key, hierarchy):
+        if cls.memory is None:
+            return
+        data = encode_hierarchy(hierarchy)
+        cls.memory.put(key, data)
+        cls._write(key, data)
+
+    @classmethod
+    def _read(cls, key):
+        path = cls.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # keep track of the last access for eviction
+            os.utime(path)
+        except OSError:
+            cls.disk_misses += 1
+            return None
+        cls.disk_hits += 1
+        return data
+
+    @classmethod
+    def _write(cls, key, data):
+        os.makedirs(cls.directory, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=cls.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmppath, cls.path(key))
+        except OSError:
+            os.unlink(tmppath)
+            raise
+        if cls.disk_maxbytes:
+            cls._evict()
+
+    @classmethod
+    def _evict(cls):
+        with cls._lock:
+            files = []
+            total = 0
+            for entry in os.scandir(cls.directory):
+                if not entry.name.endswith(cls.suffix):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            files.sort()
+            for _, size, path in files:
+                if total <= cls.disk_maxbytes:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                cls.disk_evictions += 1
+
+    @classmethod
+    def stats(cls):
+        if cls.memory is None:
+            return {}
+        return {
+            'memory': cls.memory.stats(),
+            'disk': {
+                'maxbytes': cls.disk_maxbytes,
+                'hits': cls.disk_hits,
+                'misses': cls.disk_misses,
+                'evictions': cls.disk_evictions,
+            },
+        }
@@ -6,6 +6,10 @@ import re
 import sys
 import shlex
 import json
+import time
+import multiprocessing
+from hashlib import sha1
+from multiprocessing import cpu_count
 from zipfile import ZipFile
 from datetime import datetime
 from pathlib import Path
@@ -132,9 +136,18 @@ def cli():
               default='127.0.0.1', type=str)
 @click.option('--port', help='The port to listen on (default is 5000)',
               default=5000, type=int)
+@click.option('--async', 'use_async', is_flag=True,
+              help='serve with asyncio and asyncpg (needs lopocs[async])')
 @cli.command()
-def serve(host, port):
+def serve(host, port, use_async):
     '''run lopocs server (development usage)'''
+    if use_async:
+        try:
+            from lopocs import aio
+        except ImportError as e:
+            fatal('{}, install lopocs[async] to use --async'.format(e))
+        aio.serve(host, port)
+        return
     app = create_app()
     CORS(app)
     app.run(host=host, port=port)
@@ -353,20 +366,10 @@ def _load(filename, table, column, work_dir, server_url, capacity, usewith, srid
             table, column, 0.01, 0.01, 0.01,
             offset_x, offset_y, offset_z, srid, potree_schema
         )
-        cache_file = (
-            "{0}_{1}_{2}_{3}_{4}.hcy".format(
-                lpsession.table,
-                lpsession.column,
-                lod_min,
-                lod_max,
-                '_'.join(str(e) for e in bbox)
-            )
-        )
-        pending("Building greyhound hierarchy")
-        new_hcy = greyhound.build_hierarchy_from_pg(
-            lpsession, lod_min, lod_max, bbox
-        )
-        greyhound.write_in_cache(new_hcy, cache_file)
+        pending("Storing greyhound hierarchy")
+        counts = greyhound.build_hierarchy_counts(
+            lpsession, lod_min, lod_max, bbox)
+        Session.store_hierarchy(table, column, counts)
         ok()
         create_potree_page(str(work_dir.resolve()), server_url, table, column)
 
@@ -420,6 +423,93 @@ def tileset(table, column, server_url, work_dir):
     ok()
 
 
+def write_atomic(path, data):
+    '''
+    Write data to a temporary file renamed to path, so that an interrupted
+    export never leaves a truncated file behind
+    '''
+    tmppath = '{}.{}.tmp'.format(path, os.getpid())
+    with io.open(tmppath, 'wb') as out:
+        out.write(data)
+    os.replace(tmppath, path)
+
+
+def _export_worker_init():
+    # each worker process has its own application and database connections
+    create_app()
+
+
+def _export_tile(args):
+    table, column, lod, bounds, path = args
+    data = threedtiles.get_tile(Session(table, column), bounds, lod)
+    write_atomic(path, data)
+    return len(data)
+
+
+@click.option('--table', required=True, help='table name to store pointclouds, considered in public schema if no prefix provided')
+@click.option('--column', help="column name to store patches", default="points", type=str)
+@click.option('--out-dir', type=click.Path(file_okay=False), required=True, help="directory where tileset.json and tiles are written")
+@click.option('--jobs', type=int, default=cpu_count(), help="number of worker processes")
+@cli.command('export-3dtiles')
+def export_3dtiles(table, column, out_dir, jobs):
+    """
+    Export the tileset and all the tiles of a table to static files.
+    Tiles already exported are skipped, so an interrupted export can be resumed.
+    """
+    create_app()
+
+    if '.' not in table:
+        table = 'public.{}'.format(table)
+
+    out_dir = Path(out_dir)
+    tiles_dir = out_dir / 'tiles'
+    tiles_dir.mkdir(parents=True, exist_ok=True)
+
+    lpsession = Session(table, column)
+    fullbbox = lpsession.boundingbox
+    bbox = [
+        fullbbox['xmin'], fullbbox['ymin'], fullbbox['zmin'],
+        fullbbox['xmax'], fullbbox['ymax'], fullbbox['zmax']
+    ]
+    pending('Building tileset from database')
+    tileset = threedtiles.build_tileset(lpsession, '', bbox)
+    ok()
+
+    tasks = []
+    skipped = 0
+    for lod, bounds, content in threedtiles.tile_contents(tileset):
+        # tiles are named after their url so that names are stable between exports
+        name = '{}-{}.pnts'.format(
+            lod, sha1(content['url'].encode()).hexdigest()[:16])
+        content['url'] = 'tiles/{}'.format(name)
+        path = str(tiles_dir / name)
+        if os.path.exists(path):
+            skipped += 1
+        else:
+            tasks.append((table, column, lod, bounds, path))
+
+    pending('Exporting {} tiles ({} already exported)'.format(
+        len(tasks), skipped), nl=True)
+    nbytes = 0
+    start = time.time()
+    if tasks:
+        # spawned workers do not inherit the connections of this process
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(jobs, initializer=_export_worker_init) as pool:
+            with click.progressbar(length=len(tasks), label='Tiles') as bar:
+                for size in pool.imap_unordered(_export_tile, tasks):
+                    nbytes += size
+                    bar.update(1)
+    elapsed = time.time() - start
+    ok('{} tiles, {} bytes written in {:.1f}s ({:.1f} tiles/sec)'.format(
+        len(tasks), nbytes, elapsed, len(tasks) / elapsed if elapsed else 0))
+
+    pending('Writing tileset to disk')
+    write_atomic(str(out_dir / 'tileset.json'),
+                 json.dumps(tileset, separators=(',', ':')).encode())
+    ok()
+
+
 def create_potree_page(work_dir, server_url, tablename, column):
     '''Create an html demo page with potree viewer
     '''
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+cdt = np.dtype([('Red', np.uint8), ('Green', np.uint8), ('Blue', np.uint8)])
+
+# colors of LAS Classification codes.
+# See LAS spec for codes :
+# http://www.asprs.org/wp-content/uploads/2010/12/asprs_las_format_v11.pdf
+CLASSIFICATION_COLORS = {
+    1: (176, 185, 182),  # unclassified (grey)
+    2: (226, 230, 229),  # ground (light brown)
+    3: (192, 213, 160),  # low vegetation
+    4: (171, 200, 116),  # medium vegetation
+    5: (140, 156, 8),  # high vegetation (green)
+    6: (186, 79, 63),  # building (brown)
+    9: (141, 179, 198),  # water (blue)
+}
+
+
+def classification_palette(colors=None):
+    '''
+    Returns a 256x3 uint8 lookup table of colors indexed by Classification.
+    'colors' maps codes to [r, g, b] and overrides CLASSIFICATION_COLORS,
+    unknown codes are black.
+    '''
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    for code, rgb in CLASSIFICATION_COLORS.items():
+        palette[code] = rgb
+    for code, rgb in (colors or {}).items():
+        palette[int(code)] = rgb
+    return palette
+
+
+def classification_to_rgb(points, palette, out=None):
+    """
+    map LAS Classification to RGB colors with a palette.
+
+    :param points: points as a structured numpy array
+    :param palette: lookup table returned by classification_palette
+    :param out: optional array with dtype cdt to fill
+    :returns: numpy array with dtype cdt
+    """
+    if out is None:
+        out = np.empty(len(points), dtype=cdt)
+    classification = points['Classification'].astype(np.uint8, copy=False)
+    np.take(palette, classification, axis=0,
+            out=out.view(np.uint8).reshape(-1, 3))
+    return out
+
+
+def dimension_range(points, dimensions, names):
+    '''
+    Returns the (min, max) of the dimensions 'names' from the ranges
+    computed at load time, or from the points if they are unknown
+    '''
+    try:
+        ranges = [dimensions[name] for name in names]
+        return min(r[0] for r in ranges), max(r[1] for r in ranges)
+    except (KeyError, TypeError):
+        return (min(points[name].min() for name in names),
+                max(points[name].max() for name in names))
+
+
+def colorize(points, dimensions, palette, out=None):
+    '''
+    Returns the colors of points as an array with dtype cdt:
+
+    - 16 bits colors are scaled down to 8 bits according to the bit depth
+      of the dataset
+    - Classification is mapped with 'palette'
+    - Intensity is rendered as grey levels
+
+    'dimensions' gives the [min, max] of the dimensions of the dataset.
+    Colors are written in 'out' if given.
+    '''
+    fields = points.dtype.fields.keys()
+    rgb = np.empty(len(points), dtype=cdt) if out is None else out
+
+    if not len(points):
+        pass
+    elif 'Red' in fields:
+        _, cmax = dimension_range(points, dimensions, ('Red', 'Green', 'Blue'))
+        shift = max(int(cmax).bit_length() - 8, 0)
+        for name in ('Red', 'Green', 'Blue'):
+            rgb[name] = points[name] >> shift
+    elif 'Classification' in fields:
+        classification_to_rgb(points, palette, out=rgb)
+    elif 'Intensity' in fields:
+        imin, imax = dimension_range(points, dimensions, ('Intensity',))
+        grey = points['Intensity'].astype(np.float32) - imin
+        grey = np.clip(grey * 255 / ((imax - imin) or 1), 0, 255)
+        for name in ('Red', 'Green', 'Blue'):
+            rgb[name] = grey
+    else:
+        # No colors
+        # FIXME: compute color gradient based on elevation
+        rgb.view(np.uint8)[:] = 0
+    return rgb
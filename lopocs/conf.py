@@ -14,8 +14,35 @@ class Config(object):
     DEBUG = False
     STATS = False
     STATS_SERVER_PORT = 6379
+    TILE_CACHE_SIZE = 0
+    STREAM_READS = False
+    STREAM_FETCH_SIZE = 64
+    STREAM_BUFFER_SIZE = 128
+    BINARY_PATCHES = False
+    LAZ_COMPRESSION = 'db'
+    LAZ_WORKERS = None
+    TRANSFORM_IN_APP = False
+    PREPARED_STATEMENTS = True
+    # hierarchies and tilesets are counted with one query per node
+    # ('recursive') or with one grouped query per level ('grouped')
+    HIERARCHY_MODE = 'recursive'
+    CATALOG_LISTEN = True
+    HIERARCHY_CACHE_SIZE = 32 * 1024 * 1024
+    HIERARCHY_CACHE_DISK_SIZE = 0
+    HIERARCHY_ESTIMATE = False
+    HIERARCHY_SAMPLE_PERCENT = 5
+    HIERARCHY_LOCK = False
+    PREFETCH_WORKERS = 0
+    PREFETCH_DEPTH = None
+    PREFETCH_MIN_CONNECTIONS = 2
 
     CESIUM_COLOR = "colors"
+    # {classification: [r, g, b]} overriding default colors
+    CESIUM_PALETTE = None
+    CESIUM_QUANTIZED = True
+    CESIUM_LAZ_TRANSPORT = False
+    TILESET_LEVELS = 3
+    TILESET_CACHE_SIZE = 16 * 1024 * 1024
 
     @classmethod
     def init(cls, config):
@@ -46,5 +73,77 @@ class Config(object):
         if 'STATS_SERVER_PORT' in config:
             cls.STATS_SERVER_PORT = config['STATS_SERVER_PORT']
 
+        if 'TILE_CACHE_SIZE' in config:
+            cls.TILE_CACHE_SIZE = config['TILE_CACHE_SIZE']
+
+        if 'STREAM_READS' in config:
+            cls.STREAM_READS = config['STREAM_READS']
+
+        if 'STREAM_FETCH_SIZE' in config:
+            cls.STREAM_FETCH_SIZE = config['STREAM_FETCH_SIZE']
+
+        if 'STREAM_BUFFER_SIZE' in config:
+            cls.STREAM_BUFFER_SIZE = config['STREAM_BUFFER_SIZE']
+
+        if 'BINARY_PATCHES' in config:
+            cls.BINARY_PATCHES = config['BINARY_PATCHES']
+
+        if 'LAZ_COMPRESSION' in config:
+            cls.LAZ_COMPRESSION = config['LAZ_COMPRESSION']
+
+        if 'LAZ_WORKERS' in config:
+            cls.LAZ_WORKERS = config['LAZ_WORKERS']
+
+        if 'TRANSFORM_IN_APP' in config:
+            cls.TRANSFORM_IN_APP = config['TRANSFORM_IN_APP']
+
+        if 'PREPARED_STATEMENTS' in config:
+            cls.PREPARED_STATEMENTS = config['PREPARED_STATEMENTS']
+
+        if 'HIERARCHY_MODE' in config:
+            cls.HIERARCHY_MODE = config['HIERARCHY_MODE']
+
+        if 'CATALOG_LISTEN' in config:
+            cls.CATALOG_LISTEN = config['CATALOG_LISTEN']
+
+        if 'HIERARCHY_CACHE_SIZE' in config:
+            cls.HIERARCHY_CACHE_SIZE = config['HIERARCHY_CACHE_SIZE']
+
+        if 'HIERARCHY_CACHE_DISK_SIZE' in config:
+            cls.HIERARCHY_CACHE_DISK_SIZE = config['HIERARCHY_CACHE_DISK_SIZE']
+
+        if 'HIERARCHY_ESTIMATE' in config:
+            cls.HIERARCHY_ESTIMATE = config['HIERARCHY_ESTIMATE']
+
+        if 'HIERARCHY_SAMPLE_PERCENT' in config:
+            cls.HIERARCHY_SAMPLE_PERCENT = config['HIERARCHY_SAMPLE_PERCENT']
+
+        if 'HIERARCHY_LOCK' in config:
+            cls.HIERARCHY_LOCK = config['HIERARCHY_LOCK']
+
+        if 'PREFETCH_WORKERS' in config:
+            cls.PREFETCH_WORKERS = config['PREFETCH_WORKERS']
+
+        if 'PREFETCH_DEPTH' in config:
+            cls.PREFETCH_DEPTH = config['PREFETCH_DEPTH']
+
+        if 'PREFETCH_MIN_CONNECTIONS' in config:
+            cls.PREFETCH_MIN_CONNECTIONS = config['PREFETCH_MIN_CONNECTIONS']
+
         if 'CESIUM_COLOR' in config:
             cls.CESIUM_COLOR = config['CESIUM_COLOR']
+
+        if 'CESIUM_PALETTE' in config:
+            cls.CESIUM_PALETTE = config['CESIUM_PALETTE']
+
+        if 'CESIUM_QUANTIZED' in config:
+            cls.CESIUM_QUANTIZED = config['CESIUM_QUANTIZED']
+
+        if 'CESIUM_LAZ_TRANSPORT' in config:
+            cls.CESIUM_LAZ_TRANSPORT = config['CESIUM_LAZ_TRANSPORT']
+
+        if 'TILESET_LEVELS' in config:
+            cls.TILESET_LEVELS = config['TILESET_LEVELS']
+
+        if 'TILESET_CACHE_SIZE' in config:
+            cls.TILESET_CACHE_SIZE = config['TILESET_CACHE_SIZE']
@@ -1,16 +1,26 @@
 # -*- coding: utf-8 -*-
+import io
+import os
+import select
+import time
+from threading import Lock, Thread
+from hashlib import md5
 from multiprocessing import cpu_count
-from collections import defaultdict
+from uuid import uuid4
 from contextlib import contextmanager
 from packaging import version
 
 import psycopg2.extras
 import psycopg2.extensions
 from psycopg2.extras import Json
-from psycopg2.pool import ThreadedConnectionPool
 from osgeo.osr import SpatialReference
 
-from .utils import iterable2pgarray, list_from_str_box, greyhound_types
+from .utils import (
+    iterable2pgarray, list_from_str_box, greyhound_types, copy_binary_rows,
+    pg_placeholders
+)
+from .conf import Config
+from .pool import ConnectionPool
 from .potreeschema import create_pointcloud_schema
 
 psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
@@ -25,10 +35,32 @@ create table if not exists pointcloud_lopocs (
     , max_patches_per_query integer default 4096
     , max_points_per_patch integer default NULL
     , bbox jsonb
+    , dimensions jsonb
+    , numpoints bigint
+    -- bbox and numpoints of the table when its hierarchy was stored
+    , hierarchy_bbox jsonb
+    , hierarchy_numpoints bigint
     , constraint uniq_table_col UNIQUE (schematable, "column")
     , constraint check_schematable_exists
         CHECK (to_regclass(schematable) is not null)
 );
+-- upgrade tables created by older versions
+do $$ begin
+    alter table pointcloud_lopocs add column dimensions jsonb;
+exception when duplicate_column then null;
+end $$;
+do $$ begin
+    alter table pointcloud_lopocs add column numpoints bigint;
+exception when duplicate_column then null;
+end $$;
+do $$ begin
+    alter table pointcloud_lopocs add column hierarchy_bbox jsonb;
+exception when duplicate_column then null;
+end $$;
+do $$ begin
+    alter table pointcloud_lopocs add column hierarchy_numpoints bigint;
+exception when duplicate_column then null;
+end $$;
 create table if not exists pointcloud_lopocs_outputs (
     id integer references pointcloud_lopocs(id) on delete cascade
     , pcid integer references pointcloud_formats(pcid) on delete cascade
@@ -39,11 +71,128 @@ create table if not exists pointcloud_lopocs_outputs (
     , bbox float[6]
     , constraint uniqschema UNIQUE (id, pcid)
 );
+-- point count of every octree node computed at load time
+create table if not exists pointcloud_lopocs_hierarchy (
+    id integer references pointcloud_lopocs(id) on delete cascade
+    , depth integer
+    , x integer
+    , y integer
+    , z integer
+    , npoints bigint
+    , constraint uniqnode PRIMARY KEY (id, depth, x, y, z)
+);
 -- trick to add a partial constraint
 -- only one schema is used to store patches
 create unique index if not exists uniqidx_pcid_stored
     on pointcloud_lopocs_outputs (id, pcid, stored) where (stored is true);
 
+-- generation of the lopocs catalog, incremented and notified to the
+-- listening lopocs processes on every change of the metadata tables
+do $$ begin
+    create sequence pointcloud_lopocs_generation;
+exception when duplicate_table then null;
+end $$;
+
+create or replace function lopocs_catalog_changed() returns trigger
+language plpgsql as $$
+begin
+    perform pg_notify(
+        'lopocs_catalog', nextval('pointcloud_lopocs_generation')::text);
+    return null;
+end $$;
+
+drop trigger if exists lopocs_catalog_changed on pointcloud_lopocs;
+create trigger lopocs_catalog_changed
+    after insert or update or delete or truncate on pointcloud_lopocs
+    for each statement execute procedure lopocs_catalog_changed();
+drop trigger if exists lopocs_catalog_changed on pointcloud_lopocs_outputs;
+create trigger lopocs_catalog_changed
+    after insert or update or delete or truncate on pointcloud_lopocs_outputs
+    for each statement execute procedure lopocs_catalog_changed();
+
+-- keep the statistics collected at load time up to date when patches are
+-- added to or removed from a table, once per statement from the transition
+-- table (new_patches or old_patches). Bounds are not shrunk on delete.
+create or replace function lopocs_update_statistics() returns trigger
+language plpgsql as $$
+declare
+    plid integer;
+    dims jsonb;
+    ext record;
+begin
+    select id, dimensions into plid, dims from pointcloud_lopocs
+    where schematable = TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME
+        and "column" = TG_ARGV[0];
+    if plid is null then
+        return null;
+    end if;
+
+    if TG_OP = 'DELETE' then
+        execute format(
+            'select sum(pc_numpoints(%I)) as npoints from old_patches',
+            TG_ARGV[0]) into ext;
+        if ext.npoints is not null then
+            update pointcloud_lopocs set numpoints = numpoints - ext.npoints
+            where id = plid;
+        end if;
+        return null;
+    end if;
+
+    execute format($q$
+        select sum(pc_numpoints(%1$I)) as npoints
+            , min(pc_patchmin(%1$I, 'x'))::float8 as xmin
+            , min(pc_patchmin(%1$I, 'y'))::float8 as ymin
+            , min(pc_patchmin(%1$I, 'z'))::float8 as zmin
+            , max(pc_patchmax(%1$I, 'x'))::float8 as xmax
+            , max(pc_patchmax(%1$I, 'y'))::float8 as ymax
+            , max(pc_patchmax(%1$I, 'z'))::float8 as zmax
+        from new_patches
+    $q$, TG_ARGV[0]) into ext;
+    if ext.npoints is null then
+        return null;
+    end if;
+
+    execute format($q$
+        select jsonb_object_agg(key, jsonb_build_array(
+            least(lo, pmin), greatest(hi, pmax)))
+        from (
+            select d.key
+                , (d.value ->> 0)::float8 as lo
+                , (d.value ->> 1)::float8 as hi
+                , min(pc_patchmin(p.%1$I, d.key))::float8 as pmin
+                , max(pc_patchmax(p.%1$I, d.key))::float8 as pmax
+            from jsonb_each($1) d cross join new_patches p
+            group by d.key, d.value
+        ) _
+    $q$, TG_ARGV[0]) using dims into dims;
+
+    update pointcloud_lopocs set
+        numpoints = numpoints + ext.npoints
+        , bbox = jsonb_build_object(
+            'xmin', least((bbox ->> 'xmin')::float8, ext.xmin)
+            , 'ymin', least((bbox ->> 'ymin')::float8, ext.ymin)
+            , 'zmin', least((bbox ->> 'zmin')::float8, ext.zmin)
+            , 'xmax', greatest((bbox ->> 'xmax')::float8, ext.xmax)
+            , 'ymax', greatest((bbox ->> 'ymax')::float8, ext.ymax)
+            , 'zmax', greatest((bbox ->> 'zmax')::float8, ext.zmax)
+        )
+        , dimensions = coalesce(dims, dimensions)
+    where id = plid;
+
+    -- bounds of every output, with its offsets and scales applied
+    update pointcloud_lopocs_outputs o set bbox = array[
+        ((pl.bbox ->> 'xmin')::float8 - o.offsets[1]) / o.scales[1]
+        , ((pl.bbox ->> 'ymin')::float8 - o.offsets[2]) / o.scales[2]
+        , ((pl.bbox ->> 'zmin')::float8 - o.offsets[3]) / o.scales[3]
+        , ((pl.bbox ->> 'xmax')::float8 - o.offsets[1]) / o.scales[1]
+        , ((pl.bbox ->> 'ymax')::float8 - o.offsets[2]) / o.scales[2]
+        , ((pl.bbox ->> 'zmax')::float8 - o.offsets[3]) / o.scales[3]
+    ]
+    from pointcloud_lopocs pl
+    where pl.id = plid and o.id = pl.id;
+    return null;
+end $$;
+
 -- used to clean pointcloud_lopocs table when referenced table no longer exists
 create or replace function clean_lopocs() returns void
 language sql as
@@ -66,6 +215,9 @@ select
     , min(pl.max_patches_per_query)
     , min(pl.max_points_per_patch)
     , pl.bbox
+    -- read through to_jsonb since the column is missing in older databases
+    , min((to_jsonb(pl) -> 'dimensions')::text)::jsonb
+    , min((to_jsonb(pl) ->> 'numpoints')::bigint)
 from pointcloud_lopocs pl
 join pointcloud_columns pc
     on concat(pc."schema", '.', pc."table") = pl.schematable
@@ -76,11 +228,63 @@ where
 group by pl.id, pl.bbox
 """
 
+# the sequence is missing from metadata tables created by older versions,
+# it has to be checked in its own query since the name of a relation is
+# resolved when the query is parsed
+LOPOCS_VERSIONED_QUERY = """
+select to_regclass('pointcloud_lopocs_generation') is not null
+"""
+
+# current generation of the catalog,
+# last_value is already 1 before the first nextval
+LOPOCS_GENERATION_QUERY = """
+select case when is_called then last_value else 0 end
+from pointcloud_lopocs_generation
+"""
+
+# channel notified with the new generation when the catalog changes
+LOPOCS_CATALOG_CHANNEL = 'lopocs_catalog'
+
+
+# depth of the hierarchy stored for a resource, null if there is none or
+# if points were added or removed since it was stored
+LOPOCS_HIERARCHY_DEPTH_QUERY = """
+select max(h.depth)
+from pointcloud_lopocs_hierarchy h
+join pointcloud_lopocs pl on pl.id = h.id
+where pl.schematable = %s and pl."column" = %s
+    -- read through to_jsonb since the columns are missing in older databases
+    and to_jsonb(pl) -> 'hierarchy_bbox' = pl.bbox
+    and to_jsonb(pl) -> 'hierarchy_numpoints'
+        is not distinct from to_jsonb(pl) -> 'numpoints'
+"""
+
+# point counts of the descendants of a node
+LOPOCS_HIERARCHY_QUERY = """
+select h.depth, h.x, h.y, h.z, h.npoints
+from pointcloud_lopocs_hierarchy h
+join pointcloud_lopocs pl on pl.id = h.id
+where pl.schematable = %s and pl."column" = %s
+    and h.depth between %s and %s
+    and h.x >> (h.depth - %s) = %s
+    and h.y >> (h.depth - %s) = %s
+    and h.z >> (h.depth - %s) = %s
+"""
+
 
 class LopocsException(Exception):
     pass
 
 
+class LopocsConnection(psycopg2.extensions.connection):
+    """
+    Connection keeping track of the statements prepared on it
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
 class LopocsTable():
     """
     Used to cache content of pointcloud_lopocs* tables and
@@ -106,11 +310,14 @@ class LopocsTable():
     """
     __slots__ = (
         'table', 'column', 'srid', 'pcid', 'outputs',
-        'max_patches_per_query', 'max_points_per_patch', 'bbox'
+        'max_patches_per_query', 'max_points_per_patch', 'bbox',
+        'dimensions', 'numpoints', 'hierarchy_depth', 'patch_size', 'approx_row_count',
+        'srs'
     )
 
     def __init__(self, table, column, srid, pcid, outputs,
-                 max_patches_per_query, max_points_per_patch, bbox):
+                 max_patches_per_query, max_points_per_patch, bbox,
+                 dimensions=None, numpoints=None):
         self.table = table
         self.column = column
         self.outputs = outputs
@@ -119,6 +326,21 @@ class LopocsTable():
         self.max_patches_per_query = max_patches_per_query
         self.max_points_per_patch = max_points_per_patch
         self.bbox = bbox
+        # {name: [min, max]} of every dimension, computed at load time
+        self.dimensions = dimensions or {}
+        # exact number of points, None if unknown
+        self.numpoints = numpoints
+        self.invalidate()
+
+    def invalidate(self):
+        '''
+        Forget the values computed lazily from the data
+        '''
+        # loaded lazily from pointcloud_lopocs_hierarchy, -1 if none
+        self.hierarchy_depth = None
+        self.patch_size = None
+        self.approx_row_count = None
+        self.srs = None
 
     def filter_stored_output(self):
         '''
@@ -143,6 +365,8 @@ class LopocsTable():
             'max_patches_per_query': self.max_patches_per_query,
             'max_points_per_patch': self.max_points_per_patch,
             'bbox': self.bbox,
+            'dimensions': self.dimensions,
+            'numpoints': self.numpoints,
         }
 
 
@@ -154,33 +378,77 @@ class Session():
     catalog  = {
         ('public.table', 'column'): <LopocsTable> object
     }
+
+    The catalog is a snapshot of the metadata tables at ``generation``, it
+    is replaced as a whole when reloaded, so readers never see a partial
+    catalog. The outputs list of an entry is replaced rather than appended
+    to. Values computed lazily are cached on the entries and computed again
+    after a reload.
     """
     db = None
-    catalog = defaultdict(dict)
+    dsn = None
+    catalog = {}
+    generation = None
+    _catalog_lock = Lock()
 
     @classmethod
     def clear_catalog(cls):
-        cls.catalog.clear()
+        cls.catalog = {}
+        cls.generation = None
 
     @classmethod
-    def fill_catalog(cls):
+    def invalidate(cls, table=None, column=None):
+        """
+        Forget the metadata cached for a resource, or for all of them
+        if no table is given
         """
-        Get all output tables and fill the catalog
-        Each output table should have :
+        for (ltable, lcolumn), lopocstable in cls.catalog.items():
+            if table is None or (ltable, lcolumn) == (table, column):
+                lopocstable.invalidate()
 
+    @classmethod
+    def catalog_generation(cls):
+        """
+        Current generation of the catalog, 0 if the metadata tables are
+        not versioned
+        """
+        if not cls.query(LOPOCS_VERSIONED_QUERY)[0][0]:
+            return 0
+        return cls.query(LOPOCS_GENERATION_QUERY)[0][0]
 
+    @classmethod
+    def fill_catalog(cls):
+        """
+        Load a new snapshot of the output tables and swap it in
         """
         keys = ('pcid', 'scales', 'offsets', 'point_schema', 'bbox', 'stored')
-        results = cls.query(LOPOCS_OUTPUTS_QUERY)
-        for res in results:
-            cls.catalog[(res[0], res[1])] = LopocsTable(
-                res[0], res[1], res[2], res[3],
-                [
-                    dict(zip(keys, values))
-                    for values in zip(res[4], res[5], res[6], res[7], res[8], res[9])
-                ],
-                res[10], res[11], res[12]
-            )
+        with cls._catalog_lock:
+            generation = cls.catalog_generation()
+            results = cls.query(LOPOCS_OUTPUTS_QUERY)
+            catalog = {}
+            for res in results:
+                catalog[(res[0], res[1])] = LopocsTable(
+                    res[0], res[1], res[2], res[3],
+                    [
+                        dict(zip(keys, values))
+                        for values in zip(res[4], res[5], res[6], res[7], res[8], res[9])
+                    ],
+                    res[10], res[11], res[12], res[13], res[14]
+                )
+            cls.catalog = catalog
+            cls.generation = generation
+
+    @classmethod
+    def refresh_catalog(cls):
+        """
+        Reload the catalog if it is empty, or if it changed since it was
+        loaded and no CatalogListener keeps it up to date
+        """
+        if cls.generation is None:
+            cls.fill_catalog()
+        elif not CatalogListener.listening:
+            if cls.catalog_generation() != cls.generation:
+                cls.fill_catalog()
 
     @classmethod
     def init_app(cls, app):
@@ -190,9 +458,16 @@ class Session():
         query_con = ("postgresql://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:"
                      "{PG_PORT}/{PG_NAME}"
                      .format(**app.config))
-        cls.pool = ThreadedConnectionPool(1, cpu_count(), query_con)
+        cls.pool = ConnectionPool(
+            app.config.get('PG_POOL_MIN', 1),
+            app.config.get('PG_POOL_MAX', cpu_count()),
+            query_con,
+            timeout=app.config.get('PG_POOL_TIMEOUT', 30),
+            statement_timeout=app.config.get('PG_STATEMENT_TIMEOUT'),
+            connection_factory=LopocsConnection)
         # keep some configuration element
         cls.dbname = app.config["PG_NAME"]
+        cls.dsn = query_con
 
     def __init__(self, table, column):
         """
@@ -201,10 +476,12 @@ class Session():
         :param table: table name (with schema prefixed) ex: public.mytable
         :param column: column name for patches
         """
+        if Config.CATALOG_LISTEN and self.dsn:
+            CatalogListener.start(self.dsn)
+
         if (table, column) not in self.catalog:
-            if not self.catalog:
-                # catalog empty
-                self.fill_catalog()
+            # may have been added since the catalog was loaded
+            self.refresh_catalog()
             if (table, column) not in self.catalog:
                 raise LopocsException('table or column not found in database')
 
@@ -214,32 +491,46 @@ class Session():
 
     @property
     def approx_row_count(self):
-        schema, table = self.table.split('.')
-        sql = """
-            SELECT
-                reltuples ::BIGINT AS approximate_row_count
-            FROM pg_class
-            JOIN pg_catalog.pg_namespace n
-            ON n.oid = pg_class.relnamespace
-            WHERE relname = '{}' and nspname = '{}'
-        """.format(table, schema)
-        return self.query(sql)[0][0]
+        if self.lopocstable.approx_row_count is None:
+            schema, table = self.table.split('.')
+            sql = """
+                SELECT
+                    reltuples ::BIGINT AS approximate_row_count
+                FROM pg_class
+                JOIN pg_catalog.pg_namespace n
+                ON n.oid = pg_class.relnamespace
+                WHERE relname = '{}' and nspname = '{}'
+            """.format(table, schema)
+            self.lopocstable.approx_row_count = self.query(sql)[0][0]
+        return self.lopocstable.approx_row_count
+
+    @property
+    def patches_limit(self):
+        '''
+        Maximum number of patches read by a query, None (limit null) if
+        max_patches_per_query is 0
+        '''
+        return self.lopocstable.max_patches_per_query or None
 
     @property
     def patch_size(self):
-        sql = (
-            "select pc_summary({})::json->'npts' as npts from {} limit 1"
-            .format(self.column, self.table)
-        )
-        return self.query(sql)[0][0]
+        if self.lopocstable.patch_size is None:
+            sql = (
+                "select pc_summary({})::json->'npts' as npts from {} limit 1"
+                .format(self.column, self.table)
+            )
+            self.lopocstable.patch_size = self.query(sql)[0][0]
+        return self.lopocstable.patch_size
 
     @property
     def numpoints(self):
-        sql = """
-            select sum(pc_numpoints({}))
-            from {}
-        """.format(self.column, self.table)
-        return self.query(sql)[0][0]
+        '''
+        Exact number of points collected at load time, or an estimate for
+        tables loaded by older versions
+        '''
+        if self.lopocstable.numpoints is not None:
+            return self.lopocstable.numpoints
+        return self.approx_row_count * self.patch_size
 
     @property
     def boundingbox(self):
@@ -280,15 +571,116 @@ class Session():
 
         return bb
 
+    @property
+    def hierarchy_depth(self):
+        '''
+        Maximum depth of the hierarchy stored at load time, -1 if there
+        is none or if it does not match the current content of the table.
+        Changes of the table reload the catalog, so it is checked again.
+        '''
+        if self.lopocstable.hierarchy_depth is None:
+            depth = -1
+            if self.query("select to_regclass('pointcloud_lopocs_hierarchy')")[0][0]:
+                depth = self.query(
+                    LOPOCS_HIERARCHY_DEPTH_QUERY, (self.table, self.column)
+                )[0][0]
+            self.lopocstable.hierarchy_depth = -1 if depth is None else depth
+        return self.lopocstable.hierarchy_depth
+
+    def stored_hierarchy(self, depth_min, depth_max, index):
+        '''
+        Returns point counts of the stored hierarchy for the node 'index'
+        (x, y, z) at depth 'depth_min' and its descendants down to 'depth_max'.
+        Counts are keyed by (depth, x, y, z) relative to that node.
+        '''
+        ix, iy, iz = index
+        rows = self.query(LOPOCS_HIERARCHY_QUERY, (
+            self.table, self.column, depth_min, depth_max,
+            depth_min, ix, depth_min, iy, depth_min, iz
+        ))
+        counts = {}
+        for depth, x, y, z, npoints in rows:
+            shift = depth - depth_min
+            counts[(
+                shift, x - (ix << shift), y - (iy << shift), z - (iz << shift)
+            )] = npoints
+        return counts
+
+    @classmethod
+    def store_hierarchy(cls, table, column, counts):
+        '''
+        Replace the stored hierarchy of a resource with the given point
+        counts keyed by (depth, x, y, z), computed for the current bbox and
+        number of points of the table
+        '''
+        plid = cls.query("""
+            select id from pointcloud_lopocs
+                where schematable = %s and "column" = %s;
+        """, (table, column))[0][0]
+        keys = list(counts)
+        cls.execute("""
+            delete from pointcloud_lopocs_hierarchy where id = %s;
+            update pointcloud_lopocs set
+                hierarchy_bbox = bbox, hierarchy_numpoints = numpoints
+            where id = %s;
+            insert into pointcloud_lopocs_hierarchy
+            select %s, unnest(%s::integer[]), unnest(%s::integer[]),
+                unnest(%s::integer[]), unnest(%s::integer[]), unnest(%s::bigint[])
+        """, (
+            plid, plid, plid,
+            [key[0] for key in keys], [key[1] for key in keys],
+            [key[2] for key in keys], [key[3] for key in keys],
+            [counts[key] for key in keys]
+        ))
+        cls.invalidate(table, column)
+
     @property
     def srsid(self):
         return self.lopocstable.srid
 
     @property
     def srs(self):
-        sr = SpatialReference()
-        sr.ImportFromEPSG(self.srsid)
-        return sr.ExportToWkt()
+        if self.lopocstable.srs is None:
+            sr = SpatialReference()
+            sr.ImportFromEPSG(self.srsid)
+            self.lopocstable.srs = sr.ExportToWkt()
+        return self.lopocstable.srs
+
+    @classmethod
+    def compute_statistics(cls, table, column, names):
+        '''
+        Returns the number of points and the [min, max] of each dimension
+        in 'names' from the statistics of the patches, in a single scan
+        '''
+        sql = "select sum(pc_numpoints({0})){1} from {2}".format(
+            column,
+            ''.join(
+                ", min(pc_patchmin({0}, %s)), max(pc_patchmax({0}, %s))"
+                .format(column) for _ in names),
+            table)
+        res = cls.query(sql, [name for name in names for _ in range(2)])[0]
+        # pc_patchmin/pc_patchmax return numerics, which come as Decimal
+        # and are neither json serializable nor usable with floats
+        res = [None if value is None else float(value) for value in res]
+        return int(res[0] or 0), {
+            name: [res[2 * idx + 1], res[2 * idx + 2]]
+            for idx, name in enumerate(names)
+        }
+
+    @staticmethod
+    def dimensions_boundingbox(dimensions):
+        '''
+        Returns the bounding box from the ranges of the X, Y, Z dimensions,
+        None if one of them is missing
+        '''
+        ranges = {name.lower(): rng for name, rng in dimensions.items()}
+        if not all(axis in ranges for axis in 'xyz'):
+            return None
+        bbox = {}
+        for axis in 'xyz':
+            bbox[axis + 'min'] = float(ranges[axis][0])
+            bbox[axis + 'max'] = float(ranges[axis][1])
+        return bbox
 
     @classmethod
     def patch2greyhoundschema(cls, table, column):
@@ -343,7 +735,12 @@ class Session():
             """, (table.split('.')[0], table.split('.')[1], column)
         )[0][0]
 
-        bbox = cls.compute_boundingbox(table, column)
+        json_schema = cls.patch2greyhoundschema(table, column)
+        numpoints, dimensions = cls.compute_statistics(
+            table, column, [dim['name'] for dim in json_schema])
+        bbox = cls.dimensions_boundingbox(dimensions)
+        if bbox is None:
+            bbox = cls.compute_boundingbox(table, column)
         # compute bbox with offset and scale applied
         bbox_scaled = [0] * 6
         bbox_scaled[0] = (bbox['xmin'] - offset_x) / scale_x
@@ -355,16 +752,32 @@ class Session():
 
         res = cls.query("""
             delete from pointcloud_lopocs where schematable = %s and "column" = %s;
-            insert into pointcloud_lopocs (schematable, "column", srid, bbox)
-            values (%s, %s, %s, %s) returning id
-            """, (table, column, table, column, srid, bbox))
+            insert into pointcloud_lopocs
+                (schematable, "column", srid, bbox, dimensions, numpoints)
+            values (%s, %s, %s, %s, %s, %s) returning id
+            """, (table, column, table, column, srid, bbox, dimensions,
+                  numpoints))
         plid = res[0][0]
 
+        # keep the statistics up to date when patches are appended, with
+        # transition tables (postgresql >= 10)
+        if int(cls.query('show server_version_num')[0][0]) >= 100000:
+            cls.execute("""
+                drop trigger if exists lopocs_statistics_insert_{1} on {0};
+                create trigger lopocs_statistics_insert_{1} after insert on {0}
+                    referencing new table as new_patches
+                    for each statement
+                    execute procedure lopocs_update_statistics('{1}');
+                drop trigger if exists lopocs_statistics_delete_{1} on {0};
+                create trigger lopocs_statistics_delete_{1} after delete on {0}
+                    referencing old table as old_patches
+                    for each statement
+                    execute procedure lopocs_update_statistics('{1}');
+            """.format(table, column))
+
         scales = scale_x, scale_y, scale_z
         offsets = offset_x, offset_y, offset_z
 
-        json_schema = cls.patch2greyhoundschema(table, column)
-
         cls.execute("""
             insert into pointcloud_lopocs_outputs
             (id, pcid, scales, offsets, stored, bbox, point_schema)
@@ -372,6 +785,8 @@ class Session():
         """, (
             plid, pcid, iterable2pgarray(scales), iterable2pgarray(offsets),
             iterable2pgarray(bbox_scaled), Json(json_schema)))
+        # the cached entry describes the previous load
+        cls.clear_catalog()
 
     @classmethod
     def add_output_schema(cls, table, column,
@@ -382,7 +797,12 @@ class Session():
         Adds a new schema used to stream points.
         The new point format will be added to the database if it doesn't exists
         """
-        bbox = cls.compute_boundingbox(table, column)
+        plid, bbox = cls.query("""
+            select id, bbox from pointcloud_lopocs
+                where schematable = %s and "column" = %s;
+        """, (table, column))[0]
+        if bbox is None:
+            bbox = cls.compute_boundingbox(table, column)
 
         # compute bbox with offset and scale applied
         bbox_scaled = [0] * 6
@@ -419,12 +839,6 @@ class Session():
 
         pcid = res[0][0]
 
-        # check if lopocs already contains this configuration
-        plid = cls.query("""
-            select id from pointcloud_lopocs
-                where schematable = %s and "column" = %s;
-        """, (table, column))[0][0]
-
         cls.execute("""
             insert into pointcloud_lopocs_outputs
             (id, pcid, scales, offsets, stored, bbox, point_schema)
@@ -435,13 +849,22 @@ class Session():
 
         return pcid, bbox_scaled
 
+    @classmethod
+    def available_connections(cls):
+        """Number of connections that can still be taken from the pool
+        """
+        return cls.pool.available()
+
     @classmethod
     @contextmanager
     def _conn(cls):
         conn = cls.pool.getconn()
-        conn.autocommit = True
-        yield conn
-        cls.pool.putconn(conn)
+        try:
+            conn.autocommit = True
+            yield conn
+        finally:
+            # broken connections are dropped by the pool
+            cls.pool.putconn(conn)
 
     @classmethod
     @contextmanager
@@ -465,3 +888,152 @@ class Session():
         with cls._execute(query, parameters) as cursor:
             res = cursor.fetchall()
         return res
+
+    @classmethod
+    def query_prepared(cls, query, parameters=None):
+        """Performs a single query through a server side prepared statement
+        and fetch all results.
+
+        The statement is prepared once per connection, then only executed
+        with the given parameters.
+        """
+        if not Config.PREPARED_STATEMENTS:
+            return cls.query(query, parameters)
+        parameters = parameters or ()
+        name = 'lopocs_{}'.format(md5(query.encode()).hexdigest()[:16])
+        with cls._conn() as conn:
+            with conn.cursor() as cursor:
+                if name not in conn.prepared:
+                    cursor.execute('prepare {} as {}'.format(
+                        name, pg_placeholders(query).strip().rstrip(';')))
+                    conn.prepared.add(name)
+                cursor.execute(
+                    'execute {} ({})'.format(name, ', '.join(['%s'] * len(parameters))),
+                    parameters)
+                return cursor.fetchall()
+
+    @classmethod
+    def query_binary(cls, query, parameters=None):
+        """Performs a single query through a binary COPY and returns rows
+        of memoryviews (bytea columns come back as raw bytes)
+        """
+        buf = io.BytesIO()
+        with cls._conn() as conn:
+            with conn.cursor() as cursor:
+                if parameters is not None:
+                    query = cursor.mogrify(query, parameters).decode()
+                cursor.copy_expert(
+                    'copy ({}) to stdout with (format binary)'.format(query),
+                    buf)
+        return copy_binary_rows(buf.getbuffer())
+
+    @classmethod
+    def query_patches(cls, query, parameters=None):
+        """Performs a query returning a single pcpatch column.
+
+        Patches are returned as hex wkb strings, or as memoryviews on the
+        raw wkb if BINARY_PATCHES is enabled.
+        """
+        if not Config.BINARY_PATCHES:
+            return cls.query_prepared(query, parameters)
+        # pcpatch has no binary output function, go through bytea
+        sql = (
+            "select decode(patch::text, 'hex') from ({}) as _patches(patch)"
+            .format(query.strip().rstrip(';'))
+        )
+        return cls.query_binary(sql, parameters)
+
+    @classmethod
+    def stream(cls, query, parameters=None, size=64, buffer=128):
+        """Performs a query with a server side cursor and yields results
+        by batches of ``size`` rows.
+
+        Up to ``buffer`` rows are read before being yielded, so the
+        connection goes back to the pool before the caller consumes a
+        result fitting in the buffer, however slow the client is.
+        """
+        batches = []
+        with cls._conn() as conn:
+            # named cursors only live inside a transaction
+            conn.autocommit = False
+            try:
+                name = 'lopocs_{}'.format(uuid4().hex)
+                with conn.cursor(name) as cursor:
+                    cursor.itersize = size
+                    cursor.execute(query, parameters)
+                    while True:
+                        rows = cursor.fetchmany(size)
+                        if not rows:
+                            break
+                        batches.append(rows)
+                        if len(batches) * size >= buffer:
+                            # buffer full, the connection is kept while
+                            # the caller consumes it
+                            for rows in batches:
+                                yield rows
+                            batches = []
+            finally:
+                conn.rollback()
+                conn.autocommit = True
+        for rows in batches:
+            yield rows
+
+
+class CatalogListener():
+    """
+    Thread listening to the catalog changes notified by the triggers on the
+    metadata tables, and reloading the catalog of this process when its
+    generation is behind.
+
+    The thread is started lazily so that each forked worker gets its own.
+    """
+    thread = None
+    pid = None
+    listening = False
+    # seconds between reconnection attempts
+    retry = 5
+
+    @classmethod
+    def start(cls, dsn):
+        if cls.thread is not None and cls.pid == os.getpid():
+            return
+        with Session._catalog_lock:
+            if cls.thread is not None and cls.pid == os.getpid():
+                return
+            cls.pid = os.getpid()
+            cls.listening = False
+            cls.thread = Thread(target=cls._run, args=(dsn,), daemon=True)
+            cls.thread.start()
+
+    @classmethod
+    def _run(cls, dsn):
+        while True:
+            try:
+                cls._listen(dsn)
+            except psycopg2.Error:
+                pass
+            cls.listening = False
+            time.sleep(cls.retry)
+
+    @classmethod
+    def _listen(cls, dsn):
+        conn = psycopg2.connect(dsn)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute('listen {}'.format(LOPOCS_CATALOG_CHANNEL))
+            cls.listening = True
+            # changes may have happened before listening
+            Session.fill_catalog()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                generations = [int(n.payload) for n in conn.notifies]
+                conn.notifies.clear()
+                if generations and (
+                        Session.generation is None or
+                        max(generations) > Session.generation):
+                    Session.fill_catalog()
+        finally:
+            conn.close()
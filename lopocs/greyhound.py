@@ -1,24 +1,44 @@
 # -*- coding: utf-8 -*-
 import json
+import os
 import time
+from itertools import chain
+from threading import Lock, Thread
 from binascii import unhexlify
-from concurrent.futures import ThreadPoolExecutor
 
-from flask import make_response
+import numpy as np
+from flask import make_response, Response
 
 from .database import Session
 from .utils import (
     list_from_str, read_in_cache,
-    write_in_cache, boundingbox_to_polygon,
-    patch_numpoints, hexa_signed_int32
+    patch_numpoints, patch_bytes, hexa_signed_int32, schema_dtype,
+    transform_points
 )
 from .conf import Config
 from .stats import Stats
+from .cache import TileCache, HierarchyCache
+from .workers import LazWorkers
+from .singleflight import SingleFlight, file_lock
+from .prefetch import Prefetcher
+from .octree import (
+    split_bbox, sql_count_points, assemble_hierarchy, sql_patch_sample,
+    sample_counts, count_hierarchy, hierarchy_counts
+)
+
 
+# concurrent identical requests wait for a single computation
+read_flights = SingleFlight()
+hierarchy_flights = SingleFlight()
 
 # https://github.com/potree/potree/blob/master/src/loader/GreyhoundLoader.js#L194
 LOADER_GREYHOUND_MIN_DEPTH = 8
 
+# output formats converted in the application (TRANSFORM_IN_APP) are not
+# stored in the database, they are kept here by (table, column) so that
+# catalog reloads do not drop them
+app_outputs = {}
+
 
 def GreyhoundInfo(table, column):
     # invoke a new db session
@@ -27,8 +47,7 @@ def GreyhoundInfo(table, column):
     box = session.lopocstable.bbox
     # get object representing the stored patches format
     stored_patches = session.lopocstable.filter_stored_output()
-    # number of points for the first patch
-    npoints = session.approx_row_count * session.patch_size
+    npoints = session.numpoints
 
     return {
         "baseDepth": 0,
@@ -49,34 +68,92 @@ def GreyhoundRead(table, column, offset, scale, bounds, depth,
                   depthBegin, depthEnd, schema, compress):
 
     session = Session(table, column)
+    bbox, output, lod = read_parameters(
+        session, offset, scale, bounds, depth, depthBegin, depthEnd, schema)
+
+    # get points in database
+    t0 = time.time()
+
+    key = tile_key(session, bbox, output, lod, compress)
+    cached = cached_points(key)
+    if cached:
+        [read, npoints] = cached
+    elif Config.STREAM_READS and not compress:
+        # lazperf streams cannot be split by patch so only raw points
+        # are streamed, and they bypass the tile cache
+        chunks = stream_points(session, bbox, output, lod)
+        # read the first chunk before the response starts so that errors
+        # of the query are still sent as an http error
+        first = next(chunks)
+        return Response(
+            chain([first], chunks), content_type='application/octet-stream')
+    else:
+        [read, npoints] = read_flights.do(
+            key, get_cached_points, key, session, bbox, output, lod, compress)
+
+    record_stats(t0, npoints)
+
+    # build flask response
+    response = make_response(read)
+    response.headers['content-type'] = 'application/octet-stream'
+    if prefetching():
+        response.call_on_close(
+            lambda: prefetch_children(session, bbox, output, lod, compress))
+    return response
+
 
+def cached_points(key):
+    '''
+    Returns [read, npoints] of a read request from the tile cache, or None
+    '''
+    cached = TileCache.get(key)
+    if cached:
+        Prefetcher.hit(key)
+    return cached
+
+
+def record_stats(t0, npoints):
+    '''
+    Adds the points of a read request started at t0 (seconds since the
+    epoch) to the STATS counters
+    '''
+    if not Config.STATS or npoints <= 0:
+        return
+    elapsed = int(round((time.time() - t0) * 1000))
+    stats = Stats.get()
+    Stats.set(stats['npoints'] + npoints, elapsed + stats['time_msec'])
+    stats = Stats.get()
+    print("Points/sec: ", stats['rate_sec'])
+
+
+def prefetching():
+    '''
+    True if the children of the nodes read should be prefetched
+    '''
+    return Prefetcher.enabled() and TileCache.enabled()
+
+
+def read_parameters(session, offset, scale, bounds, depth, depthBegin,
+                    depthEnd, schema):
+    '''
+    Returns the bounding box, the output format and the level of detail of
+    a read request, registering the output format if it is a new one
+    '''
     # we treat scales as list
     scales = [scale] * 3
     # convert string schema to a list of dict
     schema = json.loads(schema)
-    pcid = None
+    output = None
 
     if offset is None and scale is None and bounds is None:
         # normalization request from potree gives no bounds, no scale and
         # no offset, only a schema
-        for output in session.lopocstable.outputs:
-            if schema == output['point_schema']:
-                pcid = output['pcid']
-        if not pcid:
+        for candidate in outputs(session):
+            if schema == candidate['point_schema']:
+                output = candidate
+        if not output:
             obj = session.lopocstable.outputs[0]
-            pcid, bbox = session.add_output_schema(
-                session.table, session.column,
-                obj['scales'][0], obj['scales'][1], obj['scales'][2],
-                obj['offsets'][0], obj['offsets'][1], obj['offsets'][2],
-                session.lopocstable.srid, schema)
-            session.lopocstable.outputs.append(dict(
-                scales=scales,
-                offsets=obj['offsets'],
-                pcid=pcid,
-                point_schema=schema,
-                stored=False,
-                bbox=bbox
-            ))
+            output = new_output(session, obj['scales'], obj['offsets'], schema)
 
     else:
         offset = list_from_str(offset)
@@ -84,27 +161,14 @@ def GreyhoundRead(table, column, offset, scale, bounds, depth,
         # check if schema, scale and offset exists in our db
         requested = [scales, offsets, schema]
 
-        for output in session.lopocstable.outputs:
-            oschema = output['point_schema']
-            if requested == [output['scales'], output['offsets'], oschema]:
-                pcid = output['pcid']
-
-        if not pcid:
-            # insert new schem
-            pcid, bbox = session.add_output_schema(
-                session.table, session.column,
-                scales[0], scales[1], scales[2],
-                offsets[0], offsets[1], offsets[2],
-                session.lopocstable.srid, schema)
-            # update cache
-            session.lopocstable.outputs.append(dict(
-                scales=scales,
-                offsets=offsets,
-                pcid=pcid,
-                point_schema=schema,
-                stored=False,
-                bbox=bbox
-            ))
+        for candidate in outputs(session):
+            oschema = candidate['point_schema']
+            if requested == [candidate['scales'], candidate['offsets'], oschema]:
+                output = candidate
+
+        if not output:
+            # insert new schema
+            output = new_output(session, scales, offsets, schema)
 
     # prepare parameters
     if not bounds and depth == 0:
@@ -133,27 +197,113 @@ def GreyhoundRead(table, column, offset, scale, bounds, depth,
     if lod >= LOADER_GREYHOUND_MIN_DEPTH:
         lod -= LOADER_GREYHOUND_MIN_DEPTH
 
-    # get points in database
-    if Config.STATS:
-        t0 = int(round(time.time() * 1000))
+    return bbox, output, lod
+
+
+def prefetch_children(session, bbox, output, lod, compress):
+    '''
+    Queue the reads of the children of a node which are not in the tile
+    cache yet, up to PREFETCH_DEPTH and the depth of the dataset hierarchy
+    '''
+    depth_max = Config.DEPTH - 1
+    if Config.PREFETCH_DEPTH is not None:
+        depth_max = min(depth_max, Config.PREFETCH_DEPTH)
+    if session.hierarchy_depth >= 0:
+        depth_max = min(depth_max, session.hierarchy_depth)
+    if lod >= depth_max:
+        return
+
+    for child in split_bbox(bbox):
+        key = tile_key(session, child, output, lod + 1, compress)
+        if TileCache.contains(key):
+            continue
+        # going through read_flights lets a request for a node being
+        # prefetched wait for the prefetch
+        if not Prefetcher.submit(key, read_flights.do, key, get_cached_points,
+                                 key, session, child, output, lod + 1,
+                                 compress):
+            break
+
+
+def get_cached_points(key, session, bbox, output, lod, compress):
+    '''
+    Get points from the database and keep them in the tile cache.
+    Errors are raised to the client and nothing is cached.
+    '''
+    result = get_points(session, bbox, output, lod, compress)
+    TileCache.put(key, result)
+    return result
+
+
+def outputs(session):
+    '''
+    Returns the output formats of the session resource, the ones of the
+    catalog followed by the ones converted in the application
+    '''
+    return (session.lopocstable.outputs +
+            app_outputs.get((session.table, session.column), []))
+
+
+def new_output(session, scales, offsets, schema):
+    '''
+    Register a new output format for the session resource and add it to the
+    catalog cache.
+
+    Formats are converted by pc_transform and stored in pointcloud_formats,
+    unless TRANSFORM_IN_APP is set: they are then only kept in app_outputs
+    and converted with numpy (see transform_points).
+    '''
+    if Config.TRANSFORM_IN_APP:
+        box = session.lopocstable.bbox
+        pcid = None
+        bbox = [
+            (box['xmin'] - offsets[0]) / scales[0],
+            (box['ymin'] - offsets[1]) / scales[1],
+            (box['zmin'] - offsets[2]) / scales[2],
+            (box['xmax'] - offsets[0]) / scales[0],
+            (box['ymax'] - offsets[1]) / scales[1],
+            (box['zmax'] - offsets[2]) / scales[2],
+        ]
+    else:
+        pcid, bbox = session.add_output_schema(
+            session.table, session.column,
+            scales[0], scales[1], scales[2],
+            offsets[0], offsets[1], offsets[2],
+            session.lopocstable.srid, schema)
+    output = dict(
+        scales=scales,
+        offsets=offsets,
+        pcid=pcid,
+        point_schema=schema,
+        stored=False,
+        bbox=bbox
+    )
+    # lists are replaced rather than modified, requests may be iterating
+    # on them
+    if Config.TRANSFORM_IN_APP:
+        key = (session.table, session.column)
+        app_outputs[key] = app_outputs.get(key, []) + [output]
+    else:
+        session.lopocstable.outputs = session.lopocstable.outputs + [output]
+    return output
 
-    [read, npoints] = get_points(session, bbox, pcid, lod, compress)
 
-    if Config.STATS:
-        t1 = int(round(time.time() * 1000))
+def transformed_in_app(output):
+    return Config.TRANSFORM_IN_APP and not output['stored']
 
-    # log stats
-    if npoints > 0 and Config.STATS:
-        stats = Stats.get()
-        stats_npoints = stats['npoints'] + npoints
-        Stats.set(stats_npoints, (t1 - t0) + stats['time_msec'])
-        stats = Stats.get()
-        print("Points/sec: ", stats['rate_sec'])
 
-    # build flask response
-    response = make_response(read)
-    response.headers['content-type'] = 'application/octet-stream'
-    return response
+def tile_key(session, box, output, lod, compress):
+    '''
+    Key used to store points of a read request in the tile cache.
+    Bounds are rounded to absorb floating point noise from the
+    scale/offset conversion.
+    '''
+    bounds = tuple(round(coord, 6) for coord in box)
+    if output['pcid'] is not None:
+        okey = output['pcid']
+    else:
+        okey = json.dumps([output['scales'], output['offsets'], output['point_schema']])
+    return (session.table, session.column, okey, bounds, lod, bool(compress))
 
 
 def GreyhoundHierarchy(table, column, bounds, depthBegin, depthEnd, scale, offset):
@@ -178,190 +328,268 @@ def GreyhoundHierarchy(table, column, bounds, depthBegin, depthEnd, scale, offse
         bbox[4] = bbox[4] * scale + offset[1]
         bbox[5] = bbox[5] * scale + offset[2]
 
+    if lod_max <= session.hierarchy_depth:
+        index = node_index(session.boundingbox, bbox, lod_min)
+        if index:
+            counts = session.stored_hierarchy(lod_min, lod_max, index)
+            return assemble_hierarchy(counts, lod_max - lod_min)
+
     if lod_min == 0 and Config.ROOT_HCY:
-        filename = Config.ROOT_HCY
-    else:
-        filename = ("{0}_{1}_{2}_{3}_{4}.hcy"
-                    .format(session.table, session.column, lod_min, lod_max,
-                            '_'.join(str(e) for e in bbox)))
-    cached_hcy = read_in_cache(filename)
+        # hierarchy provided by the user
+        root_hcy = read_in_cache(Config.ROOT_HCY)
+        if root_hcy:
+            return root_hcy
 
+    key = HierarchyCache.key(session.table, session.column, lod_min, lod_max,
+                             [round(e, 6) for e in bbox])
     if Config.DEBUG:
-        print("hierarchy file: {0}".format(filename))
+        print("hierarchy cache key: {0}".format(key))
+
+    hcy = HierarchyCache.get(key)
+    if hcy is None and Config.HIERARCHY_ESTIMATE and HierarchyCache.enabled():
+        hcy = estimate_hierarchy(session, lod_min, lod_max, bbox)
+        if hcy is not None:
+            # serve the estimation until the exact hierarchy is cached
+            build_hierarchy_in_background(session, lod_min, lod_max, bbox, key)
+            return hcy
+    if hcy is None:
+        hcy = hierarchy_flights.do(
+            key, build_cached_hierarchy, key, session, lod_min, lod_max, bbox)
+
+    return hcy
+
+
+def node_index(fullbbox, bbox, depth, tolerance=1e-6):
+    '''
+    Returns the (x, y, z) index of the octree node at 'depth' matching
+    'bbox' in the octree covering 'fullbbox', None if 'bbox' is not
+    aligned on a node.
+    '''
+    ncells = 2 ** depth
+    mins = [fullbbox['xmin'], fullbbox['ymin'], fullbbox['zmin']]
+    maxs = [fullbbox['xmax'], fullbbox['ymax'], fullbbox['zmax']]
+    index = []
+    for axis in range(3):
+        size = (maxs[axis] - mins[axis]) / ncells
+        idx = int(round((bbox[axis] - mins[axis]) / size))
+        if not 0 <= idx < ncells:
+            return None
+        if (abs(bbox[axis] - (mins[axis] + idx * size)) > tolerance * size or
+                abs(bbox[axis + 3] - (mins[axis] + (idx + 1) * size)) > tolerance * size):
+            return None
+        index.append(idx)
+    return tuple(index)
+
+
+def lod_range(session, lod):
+    '''
+    Returns the first point and the number of points to select in each
+    patch for a given level of detail (adapted to midoc filter)
+    '''
+    maxppp = session.lopocstable.max_points_per_patch
+    if maxppp:
+        return 1, maxppp
 
-    if cached_hcy:
-        resp = cached_hcy
-    else:
+    beg = 0
+    for i in range(0, lod):
+        beg = beg + pow(4, i)
 
-        new_hcy = build_hierarchy_from_pg(session, lod_min, lod_max, bbox)
-        write_in_cache(new_hcy, filename)
-        resp = new_hcy
+    end = 0
+    for i in range(0, lod + 1):
+        end = end + pow(4, i)
 
-    return resp
+    return beg + 1, end - beg
 
 
 def sql_hierarchy(session, box, lod):
-    poly = boundingbox_to_polygon(box)
-
-    maxpp_patch = session.lopocstable.max_points_per_patch
-    maxpp_query = session.lopocstable.max_patches_per_query
-
+    '''
+    Returns the query and its parameters used to count the points of a
+    node of the hierarchy
+    '''
     # retrieve the number of points to select in a pcpatch
-    range_min = 1
-    range_max = 1
-
-    if maxpp_patch:
-        range_min = 1
-        range_max = maxpp_patch
-    else:
-        beg = 0
-        for i in range(0, lod):
-            beg = beg + pow(4, i)
+    range_min, range_max = lod_range(session, lod)
+    return sql_count_points(session, box, range_min, range_max, box[2], box[5])
 
-        end = 0
-        for i in range(0, lod + 1):
-            end = end + pow(4, i)
 
-        range_min = beg + 1
-        range_max = end - beg
-
-    # build the sql query
-    sql_limit = ""
-    if maxpp_query:
-        sql_limit = " limit {0} ".format(maxpp_query)
-
-    if Config.USE_MORTON:
-        sql = """
-        select
-            pc_union(pc_filterbetween(pc_range({0}, {4}, {5}), 'Z', {6}, {7} ))
-        from
-            (
-                select {0} from {1}
-                where pc_intersects(
-                    {0},
-                    st_geomfromtext('polygon (({2}))',{3})
-                ) order by morton {8}
-            )_
-        """.format(session.column, session.table, poly, session.srsid,
-                   range_min, range_max, box[2], box[5], sql_limit)
-    else:
-        sql = """
-        select
-            pc_union(pc_filterbetween(pc_range({0}, {4}, {5}), 'Z', {6}, {7} ))
-        from
-           (
-                select {0} from {1}
-                where pc_intersects(
-                    {0},
-                    st_geomfromtext('polygon (({2}))',{3})
-                ) {8}
-            )_
-        """.format(session.column, session.table, poly, session.srsid,
-                   range_min, range_max, box[2], box[5], sql_limit)
-    return sql
+def sql_order():
+    return "order by morton" if Config.USE_MORTON else ""
 
 
 def get_points_query(session, box, schema_pcid, lod, compress):
-    poly = boundingbox_to_polygon(box)
-
+    '''
+    Returns the query and its parameters used to get points of a read
+    request merged in a single patch
+    '''
     # retrieve the number of points to select in a pcpatch
-    range_min = 1
-    range_max = 1
-
-    maxppp = session.lopocstable.max_points_per_patch
+    range_min, range_max = lod_range(session, lod)
 
-    if maxppp:
-        range_min = 1
-        range_max = maxppp
-    else:
-        # adapted to midoc filter
-        beg = 0
-        for i in range(0, lod):
-            beg = beg + pow(4, i)
-
-        end = 0
-        for i in range(0, lod + 1):
-            end = end + pow(4, i)
-
-        range_min = beg + 1
-        range_max = end - beg
-
-    # build the sql query
-    sql_limit = ""
-    maxppq = session.lopocstable.max_patches_per_query
-    if maxppq:
-        sql_limit = " limit {0} ".format(maxppq)
-
-    if Config.USE_MORTON:
-        sql = "select "
-        if compress:
-            sql += "pc_compress("
-        sql += """
+    sql = """
         pc_transform(
             pc_union(
                 pc_filterbetween(
-                    pc_range({0}, {4}, {5}),
-                    'Z', {6}, {7}
+                    pc_range({0}, %s, %s),
+                    'Z', %s, %s
                 )
-            ), {9}
+            ), %s
         )
-        """
-        if compress:
-            sql += ", 'laz')"
-        sql += """
+    """
+    if compress:
+        sql = "pc_compress({}, 'laz')".format(sql)
+
+    sql = "select " + sql + """
         from
             (
                 select {0} from {1}
                 where pc_intersects(
                     {0},
-                    st_geomfromtext('polygon (({2}))',{3}))
-                order by morton {8}
+                    st_makeenvelope(%s, %s, %s, %s, %s))
+                {2} limit %s
             )_
         """
-    else:
-        sql = "select "
-        if compress:
-            sql += "pc_compress("
-        sql += """
-        pc_transform(
-            pc_union(
+    sql = sql.format(session.column, session.table, sql_order())
+    parameters = (
+        range_min, range_max, box[2], box[5], schema_pcid,
+        box[0], box[1], box[3], box[4], session.srsid,
+        session.patches_limit
+    )
+    return sql, parameters
+
+
+def get_points_stream_query(session, box, schema_pcid, lod):
+    '''
+    Same selection as get_points_query but patches are not merged
+    so that they can be fetched and sent one batch at a time
+    '''
+    range_min, range_max = lod_range(session, lod)
+
+    sql = """
+        select
+            pc_transform(
                 pc_filterbetween(
-                    pc_range({0}, {4}, {5}),
-                    'Z', {6}, {7}
-                )
-            ), {9}
-        )
-        """
-        if compress:
-            sql += ", 'laz')"
-        sql += """
+                    pc_range({0}, %s, %s),
+                    'Z', %s, %s
+                ), %s
+            )
         from
             (
                 select {0} from {1}
                 where pc_intersects(
                     {0},
-                    st_geomfromtext('polygon (({2}))',{3}))
-                {8}
+                    st_makeenvelope(%s, %s, %s, %s, %s))
+                {2} limit %s
             )_
-        """
+        """.format(session.column, session.table, sql_order())
+    parameters = (
+        range_min, range_max, box[2], box[5], schema_pcid,
+        box[0], box[1], box[3], box[4], session.srsid,
+        session.patches_limit
+    )
+    return sql, parameters
+
+
+def stream_points(session, box, output, lod):
+    '''
+    Generator yielding raw points patch batch by patch batch, followed by
+    the total number of points as expected by Greyhound clients.
+    '''
+    npoints = 0
+    transform = transformed_in_app(output)
+    if transform:
+        stored = session.lopocstable.filter_stored_output()
+        sql, parameters = get_points_stream_query(session, box, stored['pcid'], lod)
+    else:
+        sql, parameters = get_points_stream_query(session, box, output['pcid'], lod)
 
-    sql = sql.format(session.column, session.table, poly, session.srsid,
-                     range_min, range_max, box[2], box[5], sql_limit,
-                     schema_pcid)
-    return sql
+    if Config.DEBUG:
+        print(sql, parameters)
+
+    for rows in session.stream(sql, parameters, size=Config.STREAM_FETCH_SIZE,
+                               buffer=Config.STREAM_BUFFER_SIZE):
+        chunk = bytearray()
+        for pcpatch_wkb, in rows:
+            if not pcpatch_wkb:
+                continue
+            npoints += patch_numpoints(pcpatch_wkb)
+            # skip the 13 bytes header of uncompressed patches
+            if transform:
+                chunk.extend(transform_patch(pcpatch_wkb, stored, output))
+            else:
+                chunk.extend(unhexlify(pcpatch_wkb[26:]))
+        if chunk:
+            yield bytes(chunk)
 
+    if Config.DEBUG:
+        print("LOD: ", lod)
+        print("NUM POINTS STREAMED: ", npoints)
 
-def get_points(session, box, schema_pcid, lod, compress):
+    yield hexa_signed_int32(npoints)
+
+
+def transform_patch(pcpatch_wkb, stored, output):
+    '''
+    Convert an uncompressed patch in the stored format to the raw points
+    of the requested output format
+    '''
+    points = np.frombuffer(
+        patch_bytes(pcpatch_wkb),
+        dtype=schema_dtype(stored['point_schema']), offset=13)
+    return transform_points(
+        points, stored['scales'], stored['offsets'],
+        output['point_schema'], output['scales'], output['offsets']
+    ).tobytes()
 
-    npoints = 0
-    hexbuffer = bytearray()
-    sql = get_points_query(session, box, schema_pcid, lod, compress)
+
+def get_points(session, box, output, lod, compress):
+    sql, parameters = points_query(session, box, output, lod, compress)
 
     if Config.DEBUG:
-        print(sql)
+        print(sql, parameters)
+
+    rows = session.query_patches(sql, parameters)
+    # pc_union of no patch is null
+    pcpatch_wkb = rows[0][0] if rows else None
+
+    return read_points(session, pcpatch_wkb, output, lod, compress)
+
+
+def app_compressed(output, compress):
+    '''
+    True if lazperf encoding is done by our worker pool instead of the
+    database
+    '''
+    return compress and (
+        Config.LAZ_COMPRESSION == 'app' or transformed_in_app(output))
+
+
+def points_query(session, box, output, lod, compress):
+    '''
+    Returns the query and its parameters used to get the points of a read
+    request in the output format, or in the stored one if they are
+    converted with numpy
+    '''
+    if transformed_in_app(output):
+        stored = session.lopocstable.filter_stored_output()
+        return get_points_query(session, box, stored['pcid'], lod, False)
+    return get_points_query(session, box, output['pcid'], lod,
+                            compress and not app_compressed(output, compress))
+
+
+def read_points(session, pcpatch_wkb, output, lod, compress):
+    '''
+    Returns the buffer sent to Greyhound clients (points followed by their
+    number) from the patch selected by points_query, and the number of points
+    '''
+    npoints = 0
+    hexbuffer = bytearray()
+    # convert points in the database with pc_transform or here with numpy
+    transform = transformed_in_app(output)
+    # lazperf encoding done by the database or by our worker pool
+    app_compress = app_compressed(output, compress)
 
-    try:
-        pcpatch_wkb = session.query(sql)[0][0]
+    if pcpatch_wkb is None:
+        # no patch in the requested bounds
+        hexbuffer.extend(hexa_signed_int32(0))
+    else:
         # to test output from pgpointcloud :
 
         # get json schema representation
@@ -372,14 +600,21 @@ def get_points(session, box, schema_pcid, lod, compress):
         # retrieve number of points in wkb pgpointcloud patch
         npoints = patch_numpoints(pcpatch_wkb)
 
-        # extract data
-        offset = 34 if compress else 30
-        hexbuffer = unhexlify(pcpatch_wkb[offset:])
+        # extract data (header is 13 bytes, 17 with lazperf)
+        if transform:
+            stored = session.lopocstable.filter_stored_output()
+            data = transform_patch(pcpatch_wkb, stored, output)
+        else:
+            offset = 17 if compress and not app_compress else 13
+            data = patch_bytes(pcpatch_wkb)[offset:]
+
+        if app_compress:
+            data = LazWorkers.compress(data, output['point_schema'])
+
+        hexbuffer = bytearray(data)
 
         # add number of points
         hexbuffer += hexa_signed_int32(npoints)
-    except:
-        hexbuffer.extend(hexa_signed_int32(0))
 
     if Config.DEBUG:
         print("LOD: ", lod)
@@ -409,131 +644,83 @@ def fake_hierarchy(begin, end, npatchs):
     return p
 
 
-def build_hierarchy_from_pg(session, lod, lod_max, bbox):
-
-    # pcid is needed to get max attributes
-    sql = sql_hierarchy(session, bbox, lod)
-    pcpatch_wkb = session.query(sql)[0][0]
-
-    hierarchy = {}
-    if lod <= lod_max and pcpatch_wkb:
-        npoints = patch_numpoints(pcpatch_wkb)
-        hierarchy['n'] = npoints
-
-    lod += 1
-
-    # run leaf in threads
-    if lod <= lod_max:
-        # width / length / height
-        width = bbox[3] - bbox[0]
-        length = bbox[4] - bbox[1]
-        height = bbox[5] - bbox[2]
-
-        up = bbox[5]
-        middle = up - height / 2
-        down = bbox[2]
-
-        x = bbox[0]
-        y = bbox[1]
-
-        # build bboxes for leaf
-        bbox_nwd = [x, y + length / 2, down, x + width / 2, y + length, middle]
-        bbox_nwu = [x, y + length / 2, middle, x + width / 2, y + length, up]
-        bbox_ned = [x + width / 2, y + length / 2, down, x + width, y + length, middle]
-        bbox_neu = [x + width / 2, y + length / 2, middle, x + width, y + length, up]
-        bbox_swd = [x, y, down, x + width / 2, y + length / 2, middle]
-        bbox_swu = [x, y, middle, x + width / 2, y + length / 2, up]
-        bbox_sed = [x + width / 2, y, down, x + width, y + length / 2, middle]
-        bbox_seu = [x + width / 2, y, middle, x + width, y + length / 2, up]
-
-        # run leaf in threads
-        futures = {}
-        with ThreadPoolExecutor(max_workers=Session.pool.maxconn) as e:
-            futures["nwd"] = e.submit(build_hierarchy_from_pg_single, session, lod, lod_max, bbox_nwd)
-            futures["nwu"] = e.submit(build_hierarchy_from_pg_single, session, lod, lod_max, bbox_nwu)
-            futures["ned"] = e.submit(build_hierarchy_from_pg_single, session, lod, lod_max, bbox_ned)
-            futures["neu"] = e.submit(build_hierarchy_from_pg_single, session, lod, lod_max, bbox_neu)
-            futures["swd"] = e.submit(build_hierarchy_from_pg_single, session, lod, lod_max, bbox_swd)
-            futures["swu"] = e.submit(build_hierarchy_from_pg_single, session, lod, lod_max, bbox_swu)
-            futures["sed"] = e.submit(build_hierarchy_from_pg_single, session, lod, lod_max, bbox_sed)
-            futures["seu"] = e.submit(build_hierarchy_from_pg_single, session, lod, lod_max, bbox_seu)
-
-        for code, hier in futures.items():
-            hierarchy[code] = hier.result()
-
-    return hierarchy
-
-
-def build_hierarchy_from_pg_single(session, lod, lod_max, bbox):
-    # run sql
-    sql = sql_hierarchy(session, bbox, lod)
-    pcpatch_wkb = session.query(sql)[0][0]
-    hierarchy = {}
-    if lod <= lod_max and pcpatch_wkb:
-        npoints = patch_numpoints(pcpatch_wkb)
-        hierarchy['n'] = npoints
-
-    lod += 1
-
-    if lod <= lod_max:
-        # width  /  length  /  height
-        width = bbox[3] - bbox[0]
-        length = bbox[4] - bbox[1]
-        height = bbox[5] - bbox[2]
-
-        up = bbox[5]
-        middle = up - height / 2
-        down = bbox[2]
-
-        x = bbox[0]
-        y = bbox[1]
-
-        # nwd
-        bbox_nwd = [x, y + length / 2, down, x + width / 2, y + length, middle]
-        h_nwd = build_hierarchy_from_pg_single(session, lod, lod_max, bbox_nwd)
-        if h_nwd:
-            hierarchy['nwd'] = h_nwd
-
-        # nwu
-        bbox_nwu = [x, y + length / 2, middle, x + width / 2, y + length, up]
-        h_nwu = build_hierarchy_from_pg_single(session, lod, lod_max, bbox_nwu)
-        if h_nwu:
-            hierarchy['nwu'] = h_nwu
-
-        # ned
-        bbox_ned = [x + width / 2, y + length / 2, down, x + width, y + length, middle]
-        h_ned = build_hierarchy_from_pg_single(session, lod, lod_max, bbox_ned)
-        if h_ned:
-            hierarchy['ned'] = h_ned
-
-        # neu
-        bbox_neu = [x + width / 2, y + length / 2, middle, x + width, y + length, up]
-        h_neu = build_hierarchy_from_pg_single(session, lod, lod_max, bbox_neu)
-        if h_neu:
-            hierarchy['neu'] = h_neu
-
-        # swd
-        bbox_swd = [x, y, down, x + width / 2, y + length / 2, middle]
-        h_swd = build_hierarchy_from_pg_single(session, lod, lod_max, bbox_swd)
-        if h_swd:
-            hierarchy['swd'] = h_swd
-
-        # swu
-        bbox_swu = [x, y, middle, x + width / 2, y + length / 2, up]
-        h_swu = build_hierarchy_from_pg_single(session, lod, lod_max, bbox_swu)
-        if h_swu:
-            hierarchy['swu'] = h_swu
-
-        # sed
-        bbox_sed = [x + width / 2, y, down, x + width, y + length / 2, middle]
-        h_sed = build_hierarchy_from_pg_single(session, lod, lod_max, bbox_sed)
-        if h_sed:
-            hierarchy['sed'] = h_sed
-
-        # seu
-        bbox_seu = [x + width / 2, y, middle, x + width, y + length / 2, up]
-        h_seu = build_hierarchy_from_pg_single(session, lod, lod_max, bbox_seu)
-        if h_seu:
-            hierarchy['seu'] = h_seu
-
-    return hierarchy
+def estimate_hierarchy(session, lod_min, lod_max, bbox):
+    '''
+    Approximate the hierarchy of a node from a sample of the patches,
+    returns None if the sample is empty
+    '''
+    percent = Config.HIERARCHY_SAMPLE_PERCENT
+    sql, parameters = sql_patch_sample(session, bbox, percent)
+    patches = session.query(sql, parameters)
+    if not patches:
+        return None
+    ranges = [lod_range(session, lod) for lod in range(lod_min, lod_max + 1)]
+    counts = sample_counts(patches, bbox, ranges, 100 / percent)
+    return assemble_hierarchy(counts, lod_max - lod_min)
+
+
+# keys of the hierarchies being built in background
+_background_builds = set()
+_background_lock = Lock()
+
+
+def build_hierarchy_in_background(session, lod_min, lod_max, bbox, key):
+    '''
+    Build the exact hierarchy of a node in a thread and store it in the
+    hierarchy cache under 'key'
+    '''
+    with _background_lock:
+        if key in _background_builds:
+            return
+        _background_builds.add(key)
+
+    def build():
+        try:
+            hierarchy_flights.do(key, build_cached_hierarchy,
+                                 key, session, lod_min, lod_max, bbox)
+        finally:
+            with _background_lock:
+                _background_builds.discard(key)
+
+    Thread(target=build, daemon=True).start()
+
+
+def build_cached_hierarchy(key, session, lod_min, lod_max, bbox):
+    '''
+    Build a hierarchy and store it in the hierarchy cache under 'key'.
+
+    With HIERARCHY_LOCK, builds are serialized between processes with lock
+    files in CACHE_DIR (one of 256 picked from the key), and the cache is
+    checked again once the lock is held since another process may have
+    built the same hierarchy meanwhile.
+    '''
+    if not Config.HIERARCHY_LOCK:
+        hcy = build_hierarchy(session, lod_min, lod_max, bbox)
+        HierarchyCache.put(key, hcy)
+        return hcy
+
+    lockfile = os.path.join(
+        Config.CACHE_DIR, 'hierarchy-{0}.lock'.format(key[:2]))
+    with file_lock(lockfile):
+        hcy = HierarchyCache.get(key)
+        if hcy is None:
+            hcy = build_hierarchy(session, lod_min, lod_max, bbox)
+            HierarchyCache.put(key, hcy)
+    return hcy
+
+
+def build_hierarchy(session, lod_min, lod_max, bbox):
+    '''
+    Compute the hierarchy of a node with the builder set by HIERARCHY_MODE
+    '''
+    return count_hierarchy(
+        session, bbox, lod_min, lod_max, lod_range, sql_hierarchy)
+
+
+def build_hierarchy_counts(session, lod_min, lod_max, bbox):
+    '''
+    Returns point counts of the nodes under 'bbox' keyed by (depth, x, y, z),
+    depth being relative to lod_min, counted like the hierarchies built on
+    request
+    '''
+    return hierarchy_counts(build_hierarchy(session, lod_min, lod_max, bbox))
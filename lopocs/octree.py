@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from threading import Condition, Thread
+
+from .conf import Config
+
+# children names of an octree node: north/south (y), west/east (x), up/down (z)
+OCTANTS = ('nwd', 'nwu', 'ned', 'neu', 'swd', 'swu', 'sed', 'seu')
+
+
+def octant_offset(code):
+    '''
+    Returns the (x, y, z) index offsets of a child in its parent grid cell
+    '''
+    return (
+        1 if code[1] == 'e' else 0,
+        1 if code[0] == 'n' else 0,
+        1 if code[2] == 'u' else 0,
+    )
+
+
+def split_bbox(bbox):
+    '''
+    Split a bounding box in 8 children, ordered like OCTANTS
+    '''
+    width = bbox[3] - bbox[0]
+    length = bbox[4] - bbox[1]
+    height = bbox[5] - bbox[2]
+
+    up = bbox[5]
+    middle = up - height / 2
+    down = bbox[2]
+
+    x = bbox[0]
+    y = bbox[1]
+
+    bbox_nwd = [x, y + length / 2, down, x + width / 2, y + length, middle]
+    bbox_nwu = [x, y + length / 2, middle, x + width / 2, y + length, up]
+    bbox_ned = [x + width / 2, y + length / 2, down, x + width, y + length, middle]
+    bbox_neu = [x + width / 2, y + length / 2, middle, x + width, y + length, up]
+    bbox_swd = [x, y, down, x + width / 2, y + length / 2, middle]
+    bbox_swu = [x, y, middle, x + width / 2, y + length / 2, up]
+    bbox_sed = [x + width / 2, y, down, x + width, y + length / 2, middle]
+    bbox_seu = [x + width / 2, y, middle, x + width, y + length / 2, up]
+
+    return [bbox_nwd, bbox_nwu, bbox_ned, bbox_neu, bbox_swd, bbox_swu,
+            bbox_sed, bbox_seu]
+
+
+def sql_grid_counts(session, box, depth, range_min, range_max):
+    '''
+    Returns the query and its parameters used to count, in a single pass,
+    the points selected by pc_range(range_min, range_max) in every cell of
+    the regular grid obtained by splitting 'box' 'depth' times.
+
+    Cells are counted like sql_count_points counts a node: a patch is
+    counted in every cell its envelope spans, with its points filtered on
+    the Z range of the cell, and at most max_patches_per_query patches (in
+    morton order if enabled) intersecting the X/Y range of a cell are
+    counted.
+
+    Each result row is (ix, iy, iz, npoints) for non-empty cells only.
+    '''
+    ncells = 2 ** depth
+    sizes = [
+        (box[3] - box[0]) / ncells,
+        (box[4] - box[1]) / ncells,
+        (box[5] - box[2]) / ncells,
+    ]
+    morton = Config.USE_MORTON
+    sql = """
+    with grid as (
+        select %s::float8 as x0, %s::float8 as y0, %s::float8 as z0
+            , %s::float8 as sx, %s::float8 as sy, %s::float8 as sz
+            , %s::integer as imax
+    )
+    select ix, iy, iz, sum(npoints)
+    from
+        (
+            select ix, iy, iz
+                , case when zmin >= z0 + iz * sz and zmax <= z0 + (iz + 1) * sz
+                    then greatest(least(pc_numpoints(patch) - %s + 1, %s), 0)
+                    else pc_numpoints(pc_filterbetween(
+                        pc_range(patch, %s, %s), 'Z',
+                        z0 + iz * sz, z0 + (iz + 1) * sz))
+                end as npoints
+            from
+                (
+                    select patch, zmin, zmax, ix, iy
+                        , row_number() over (partition by ix, iy {2}) as patch_rank
+                    from
+                        (
+                            select {0} as patch
+                                , pc_patchmin({0}, 'X') as xmin
+                                , pc_patchmax({0}, 'X') as xmax
+                                , pc_patchmin({0}, 'Y') as ymin
+                                , pc_patchmax({0}, 'Y') as ymax
+                                , pc_patchmin({0}, 'Z') as zmin
+                                , pc_patchmax({0}, 'Z') as zmax
+                                {3}
+                            from {1}
+                            where pc_intersects({0}, st_makeenvelope(%s, %s, %s, %s, %s))
+                        )_patches
+                        cross join grid
+                        cross join lateral generate_series(
+                            {4}, {5}) as ix
+                        cross join lateral generate_series(
+                            {6}, {7}) as iy
+                )_cells
+                cross join grid
+                cross join lateral generate_series(
+                    {8}, {9}) as iz
+            where patch_rank <= coalesce(%s::bigint, patch_rank)
+        )_
+    group by ix, iy, iz
+    having sum(npoints) > 0
+    """.format(session.column, session.table,
+               "order by morton" if morton else "",
+               ", morton" if morton else "",
+               grid_index('xmin', 'x0', 'sx'), grid_index('xmax', 'x0', 'sx'),
+               grid_index('ymin', 'y0', 'sy'), grid_index('ymax', 'y0', 'sy'),
+               grid_index('zmin', 'z0', 'sz'), grid_index('zmax', 'z0', 'sz'))
+    parameters = (
+        box[0], box[1], box[2], sizes[0], sizes[1], sizes[2], ncells - 1,
+        range_min, range_max, range_min, range_max,
+        box[0], box[1], box[3], box[4], session.srsid,
+        session.patches_limit
+    )
+    return sql, parameters
+
+
+def grid_index(value, origin, size):
+    '''
+    SQL expression of the index of the grid cell holding 'value', clamped
+    to the grid (flat boxes have a single cell along their flat axis)
+    '''
+    return (
+        "least(greatest(coalesce(floor(({0} - {1}) / nullif({2}, 0)), 0), 0), "
+        "imax)::integer".format(value, origin, size)
+    )
+
+
+def sql_count_points(session, box, range_min, range_max, zmin, zmax):
+    '''
+    Returns the query and its parameters used to count the points
+    selected by pc_range(range_min, range_max) and between zmin and zmax in
+    the patches intersecting 'box', without merging them.
+
+    The Z filter is skipped for patches fully inside [zmin, zmax].
+    The query returns NULL if no patch intersects 'box'.
+    '''
+    sql = """
+    select
+        sum(
+            case when pc_patchmin({0}, 'Z') >= %s and pc_patchmax({0}, 'Z') <= %s
+            then greatest(least(pc_numpoints({0}) - %s + 1, %s), 0)
+            else pc_numpoints(
+                pc_filterbetween(pc_range({0}, %s, %s), 'Z', %s, %s)
+            )
+            end
+        )
+    from
+        (
+            select {0} from {1}
+            where pc_intersects({0}, st_makeenvelope(%s, %s, %s, %s, %s))
+            {2} limit %s
+        )_
+    """.format(session.column, session.table,
+               "order by morton" if Config.USE_MORTON else "")
+    parameters = (
+        zmin, zmax, range_min, range_max,
+        range_min, range_max, zmin, zmax,
+        box[0], box[1], box[3], box[4], session.srsid,
+        session.patches_limit
+    )
+    return sql, parameters
+
+
+def sql_patch_sample(session, box, percent):
+    '''
+    Returns the query and its parameters used to fetch the center and the
+    number of points of a random sample of 'percent' % of the patches
+    intersecting 'box'.
+    '''
+    sql = """
+    select
+        st_x(c), st_y(c), (zmin + zmax) / 2, npoints
+    from
+        (
+            select
+                st_centroid(pc_envelopegeometry({0})) as c
+                , pc_patchmin({0}, 'Z') as zmin
+                , pc_patchmax({0}, 'Z') as zmax
+                , pc_numpoints({0}) as npoints
+            from {1} tablesample system (%s)
+            where pc_intersects({0}, st_makeenvelope(%s, %s, %s, %s, %s))
+        )_
+    where zmax >= %s and zmin <= %s
+    """.format(session.column, session.table)
+    parameters = (
+        percent,
+        box[0], box[1], box[3], box[4], session.srsid,
+        box[2], box[5],
+    )
+    return sql, parameters
+
+
+def sample_counts(patches, box, ranges, factor):
+    '''
+    Estimate the point counts of the cells of the octree covering 'box'
+    from a sample of patches given as (x, y, z, npoints) rows.
+
+    ranges[depth] is the (first point, number of points) selected in each
+    patch at a depth relative to 'box', as returned by lod_range.
+    All the points a patch gives to a depth are put in the cell holding
+    its center, then multiplied by 'factor'.
+    Returns a dict keyed like the one of assemble_hierarchy.
+    '''
+    counts = {}
+    for row in patches:
+        npoints = row[3]
+        rel = []
+        for axis in range(3):
+            size = (box[axis + 3] - box[axis]) or 1
+            rel.append(min(max((row[axis] - box[axis]) / size, 0), 1))
+        for depth, (range_min, range_max) in enumerate(ranges):
+            n = max(min(npoints - range_min + 1, range_max), 0)
+            if not n:
+                continue
+            ncells = 2 ** depth
+            key = (depth,) + tuple(min(int(r * ncells), ncells - 1) for r in rel)
+            counts[key] = counts.get(key, 0) + n * factor
+    return {key: int(round(n)) for key, n in counts.items()}
+
+
+def assemble_hierarchy(counts, depth_max):
+    '''
+    Build a Greyhound hierarchy (nested dicts with 'n' and children named
+    after OCTANTS) from a dict of point counts keyed by
+    (depth, ix, iy, iz), depth being relative to the root node.
+    Empty children are omitted.
+    '''
+    # cells having at least one non-empty descendant
+    populated = set()
+    for depth, ix, iy, iz in counts:
+        while depth >= 0 and (depth, ix, iy, iz) not in populated:
+            populated.add((depth, ix, iy, iz))
+            depth, ix, iy, iz = depth - 1, ix // 2, iy // 2, iz // 2
+    return _assemble(counts, populated, depth_max, (0, 0, 0, 0))
+
+
+def _assemble(counts, populated, depth_max, key):
+    node = {}
+    if key in counts:
+        node['n'] = counts[key]
+    depth = key[0]
+    if depth < depth_max:
+        for code in OCTANTS:
+            offset = octant_offset(code)
+            child = (depth + 1,) + tuple(
+                2 * idx + off for idx, off in zip(key[1:], offset))
+            if child in populated:
+                node[code] = _assemble(counts, populated, depth_max, child)
+    return node
+
+
+def hierarchy_counts(hierarchy, key=(0, 0, 0, 0)):
+    '''
+    Returns the point counts of the nodes of a hierarchy (nested dicts)
+    keyed by (depth, ix, iy, iz), the reverse of assemble_hierarchy
+    '''
+    counts = {}
+    if 'n' in hierarchy:
+        counts[key] = hierarchy['n']
+    for code in OCTANTS:
+        if code in hierarchy:
+            offset = octant_offset(code)
+            child = (key[0] + 1,) + tuple(
+                2 * idx + off for idx, off in zip(key[1:], offset))
+            counts.update(hierarchy_counts(hierarchy[code], child))
+    return counts
+
+
+class OctreeNode():
+    __slots__ = ('bbox', 'lod', 'value', 'children')
+
+    def __init__(self, bbox, lod):
+        self.bbox = bbox
+        self.lod = lod
+        self.value = None
+        # None or a list of nodes ordered like OCTANTS
+        self.children = None
+
+
+def node_to_hierarchy(node):
+    '''
+    Convert a visited OctreeNode to the nested dicts used by Greyhound
+    '''
+    hierarchy = {}
+    if node.value is not None:
+        hierarchy['n'] = node.value
+    for code, child in zip(OCTANTS, node.children or []):
+        child_hierarchy = node_to_hierarchy(child)
+        if child_hierarchy:
+            hierarchy[code] = child_hierarchy
+    return hierarchy
+
+
+def grid_counts(session, box, lod_min, lod_max, lod_range):
+    '''
+    Returns point counts of every non-empty node under 'box' keyed by
+    (depth, x, y, z), depth being relative to lod_min, with one grouped
+    query per level of detail. 'lod_range(session, lod)' returns the range
+    of points selected in each patch at 'lod'.
+    '''
+    counts = {}
+    for lod in range(lod_min, lod_max + 1):
+        range_min, range_max = lod_range(session, lod)
+        sql, parameters = sql_grid_counts(
+            session, box, lod - lod_min, range_min, range_max)
+        for ix, iy, iz, npoints in session.query_prepared(sql, parameters):
+            counts[(lod - lod_min, ix, iy, iz)] = npoints
+    return counts
+
+
+def count_visitor(session, sql_count):
+    '''
+    Returns a function used by OctreeWalker to count the points of a node
+    with the query built by 'sql_count(session, bbox, lod)'. Children are
+    visited only if some patches intersect the node.
+    '''
+    def visit(bbox, lod):
+        sql, parameters = sql_count(session, bbox, lod)
+        npoints = session.query_prepared(sql, parameters)[0][0]
+        return npoints, npoints is not None
+    return visit
+
+
+def count_hierarchy(session, box, lod_min, lod_max, lod_range, sql_count):
+    '''
+    Returns the hierarchy of the node 'box' at lod_min down to lod_max as
+    nested dicts like assemble_hierarchy. It is computed with one grouped
+    query per level if HIERARCHY_MODE is 'grouped', else with one query per
+    node, nodes being queried in parallel using every connection of the
+    pool and children of empty nodes being skipped.
+    '''
+    if Config.HIERARCHY_MODE == 'grouped':
+        counts = grid_counts(session, box, lod_min, lod_max, lod_range)
+        return assemble_hierarchy(counts, lod_max - lod_min)
+
+    walker = OctreeWalker(
+        count_visitor(session, sql_count), session.pool.maxconn)
+    return node_to_hierarchy(walker.walk([(box, lod_min)], lod_max)[0])
+
+
+class OctreeWalker():
+    """
+    Visit octree nodes with a pool of threads sharing a single task queue.
+
+    ``visit(bbox, lod)`` is called once for every node and returns a
+    (value, descend) tuple. Children of a node are only visited if
+    ``descend`` is true, so empty subtrees are pruned.
+
+    When more than ``max_pending`` nodes are waiting in the queue, a worker
+    visits the children of its node itself (depth first) instead of
+    queuing them, which bounds the queue without blocking workers.
+    """
+
+    def __init__(self, visit, max_workers, max_pending=None):
+        self.visit = visit
+        self.max_workers = max_workers
+        self.max_pending = max_pending or 8 * max_workers
+        self.lod_max = 0
+        self.queue = deque()
+        self.pending = 0
+        self.error = None
+        self.cond = Condition()
+
+    def walk(self, roots, lod_max):
+        '''
+        Visit the nodes under each (bbox, lod) of 'roots' down to lod_max.
+        Returns the list of root OctreeNode.
+        '''
+        self.lod_max = lod_max
+        self.error = None
+        nodes = [OctreeNode(bbox, lod) for bbox, lod in roots]
+        self.queue.extend(nodes)
+        self.pending = len(nodes)
+
+        threads = [Thread(target=self._work) for _ in range(self.max_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.error:
+            raise self.error
+        return nodes
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.queue and self.pending:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                node = self.queue.popleft()
+            try:
+                self._process(node)
+            except Exception as exc:
+                with self.cond:
+                    self.error = exc
+                    # drop remaining work
+                    self.pending -= len(self.queue)
+                    self.queue.clear()
+            with self.cond:
+                self.pending -= 1
+                if not self.pending:
+                    self.cond.notify_all()
+
+    def _process(self, node):
+        node.value, descend = self.visit(node.bbox, node.lod)
+        if not descend or node.lod >= self.lod_max or self.error:
+            return
+        node.children = [
+            OctreeNode(bbox, node.lod + 1) for bbox in split_bbox(node.bbox)
+        ]
+        inline = []
+        with self.cond:
+            for child in node.children:
+                if len(self.queue) < self.max_pending:
+                    self.queue.append(child)
+                    self.pending += 1
+                else:
+                    inline.append(child)
+            self.cond.notify_all()
+        for child in inline:
+            self._process(child)
+
+
+# header of binary encoded hierarchies, followed by a format version
+HIERARCHY_MAGIC = b'LHCY\x01'
+
+
+def _write_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(buf, pos):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_hierarchy(hierarchy):
+    '''
+    Encode a Greyhound hierarchy in a compact binary form.
+    Nodes are written depth first, each one as a byte giving the children
+    present (bit i for OCTANTS[i]) followed by a varint holding n + 1
+    (0 if the node has no 'n').
+    '''
+    buf = bytearray(HIERARCHY_MAGIC)
+    stack = [hierarchy]
+    while stack:
+        node = stack.pop()
+        mask = 0
+        for bit, code in enumerate(OCTANTS):
+            if code in node:
+                mask |= 1 << bit
+        buf.append(mask)
+        _write_varint(buf, node['n'] + 1 if 'n' in node else 0)
+        stack.extend(node[code] for code in reversed(OCTANTS) if code in node)
+    return bytes(buf)
+
+
+def decode_hierarchy(buf):
+    '''
+    Decode a hierarchy encoded with encode_hierarchy
+    '''
+    if not buf.startswith(HIERARCHY_MAGIC):
+        raise ValueError('not an encoded hierarchy')
+    pos = len(HIERARCHY_MAGIC)
+
+    def node_at(pos):
+        node = {}
+        mask = buf[pos]
+        npoints, pos = _read_varint(buf, pos + 1)
+        if npoints:
+            node['n'] = npoints - 1
+        for bit, code in enumerate(OCTANTS):
+            if mask & (1 << bit):
+                node[code], pos = node_at(pos)
+        return node, pos
+
+    return node_at(pos)[0]
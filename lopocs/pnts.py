@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Writer of 3D Tiles point cloud tiles (pnts)
+
+https://github.com/AnalyticalGraphicsInc/3d-tiles/tree/master/TileFormats/PointCloud
+"""
+import json
+import struct
+
+import numpy as np
+
+from .colors import cdt, colorize
+
+PNTS_MAGIC = b'pnts'
+PNTS_VERSION = 1
+PNTS_HEADER_SIZE = 28
+UINT16_MAX = np.iinfo(np.uint16).max
+
+
+def _align(size, alignment=8):
+    return (size + alignment - 1) // alignment * alignment
+
+
+def quantizable(points):
+    '''
+    True if the X, Y, Z integers of points fit in uint16
+    '''
+    if not len(points):
+        return True
+    return all(
+        points[dim].min() >= 0 and points[dim].max() <= UINT16_MAX
+        for dim in ('X', 'Y', 'Z')
+    )
+
+
+def encode_pnts(points, scales, offsets, dimensions=None, palette=None,
+                quantize=True):
+    '''
+    Encode points read from a patch in a pnts tile.
+
+    X, Y and Z of 'points' are integers: coordinates are
+    offsets + X * scales. Positions are written as POSITION_QUANTIZED uint16
+    when they fit (which is the case for datasets loaded for cesium, see
+    compute_scale_for_cesium), else as float32 relative to RTC_CENTER.
+
+    Colors are computed with colors.colorize from 'dimensions' and
+    'palette'.
+
+    The tile is written in a single preallocated buffer which is returned.
+    '''
+    npoints = len(points)
+    quantize = quantize and quantizable(points)
+
+    feature_table = {'POINTS_LENGTH': npoints}
+    if quantize:
+        position_dtype = np.uint16
+        feature_table['POSITION_QUANTIZED'] = {'byteOffset': 0}
+        feature_table['QUANTIZED_VOLUME_OFFSET'] = list(offsets)
+        feature_table['QUANTIZED_VOLUME_SCALE'] = [
+            scale * UINT16_MAX for scale in scales]
+    else:
+        position_dtype = np.float32
+        feature_table['POSITION'] = {'byteOffset': 0}
+        feature_table['RTC_CENTER'] = list(offsets)
+
+    positions_size = _align(3 * npoints * np.dtype(position_dtype).itemsize)
+    feature_table['RGB'] = {'byteOffset': positions_size}
+    colors_size = _align(npoints * cdt.itemsize)
+
+    # binary body must start on a 8-byte boundary
+    ft_json = json.dumps(feature_table, separators=(',', ':')).encode()
+    ft_json_size = _align(PNTS_HEADER_SIZE + len(ft_json)) - PNTS_HEADER_SIZE
+    ft_json = ft_json.ljust(ft_json_size, b' ')
+
+    ft_bin_size = positions_size + colors_size
+    total = PNTS_HEADER_SIZE + ft_json_size + ft_bin_size
+
+    out = bytearray(total)
+    struct.pack_into(
+        '<4s6I', out, 0, PNTS_MAGIC, PNTS_VERSION, total,
+        ft_json_size, ft_bin_size, 0, 0)
+    out[PNTS_HEADER_SIZE:PNTS_HEADER_SIZE + ft_json_size] = ft_json
+
+    body = PNTS_HEADER_SIZE + ft_json_size
+    positions = np.frombuffer(
+        out, dtype=position_dtype, count=3 * npoints, offset=body
+    ).reshape(npoints, 3)
+    for axis, dim in enumerate(('X', 'Y', 'Z')):
+        if quantize:
+            positions[:, axis] = points[dim]
+        else:
+            np.multiply(points[dim], scales[axis], out=positions[:, axis],
+                        casting='unsafe')
+
+    colors = np.frombuffer(
+        out, dtype=cdt, count=npoints, offset=body + positions_size)
+    colorize(points, dimensions or {}, palette, out=colors)
+
+    return out
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import deque
+from threading import Condition
+
+import psycopg2
+from psycopg2.extensions import (
+    TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+)
+from psycopg2.pool import PoolError
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class ConnectionPool():
+    """
+    Thread safe pool of connections.
+
+    Unlike psycopg2 pools, ``getconn`` waits up to ``timeout`` seconds for a
+    connection to be released when ``maxconn`` connections are in use.
+    Connections closed or left in an unknown state are dropped when they
+    are released and replaced on demand.
+
+    ``statement_timeout`` (milliseconds) is set on every connection.
+    """
+
+    def __init__(self, minconn, maxconn, dsn, timeout=30,
+                 statement_timeout=None, connection_factory=None):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.dsn = dsn
+        self.timeout = timeout
+        self.statement_timeout = statement_timeout
+        self.connection_factory = connection_factory
+        self.closed = False
+
+        self._idle = deque()
+        self._used = set()
+        # connections opened or being opened
+        self._size = 0
+        self._cond = Condition()
+
+        # gauges
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.recycled = 0
+        self.acquire_time = 0.
+        self.acquire_time_max = 0.
+
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self):
+        kwargs = {}
+        if self.connection_factory is not None:
+            kwargs['connection_factory'] = self.connection_factory
+        if self.statement_timeout:
+            kwargs['options'] = '-c statement_timeout={}'.format(
+                int(self.statement_timeout))
+        return psycopg2.connect(self.dsn, **kwargs)
+
+    def available(self):
+        '''
+        Number of connections that can be acquired without waiting
+        '''
+        return self.maxconn - len(self._used)
+
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        conn = None
+        with self._cond:
+            if self.closed:
+                raise PoolError('connection pool is closed')
+            self.waiting += 1
+            try:
+                while True:
+                    if self._idle:
+                        conn = self._idle.pop()
+                        if not conn.closed:
+                            break
+                        # closed by the server while idle
+                        self._size -= 1
+                        self.recycled += 1
+                        conn = None
+                        continue
+                    if self._size < self.maxconn:
+                        # open a new connection outside of the lock
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(
+                            'no connection available after {}s'.format(timeout))
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+        elapsed = time.monotonic() - start
+        with self._cond:
+            self._used.add(conn)
+            self.acquired += 1
+            self.acquire_time += elapsed
+            self.acquire_time_max = max(self.acquire_time_max, elapsed)
+        return conn
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        else:
+            close = True
+
+        if close and not conn.closed:
+            conn.close()
+
+        with self._cond:
+            self._used.discard(conn)
+            if close:
+                self._size -= 1
+                self.recycled += 1
+            elif self.closed:
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self.closed = True
+            while self._idle:
+                self._idle.pop().close()
+            self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'size': self._size,
+            'maxconn': self.maxconn,
+            'in_use': len(self._used),
+            'idle': len(self._idle),
+            'waiting': self.waiting,
+            'acquired': self.acquired,
+            'timeouts': self.timeouts,
+            'recycled': self.recycled,
+            'acquire_ms_avg': (
+                1000 * self.acquire_time / self.acquired if self.acquired else 0),
+            'acquire_ms_max': 1000 * self.acquire_time_max,
+        }
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from .database import Session
+
+
+class Prefetcher():
+    """
+    Background threads filling the tile cache with nodes that are likely
+    to be requested next.
+
+    A prefetch is skipped when ``max_pending`` prefetches are already queued
+    or running, or when less than ``min_connections`` connections are left
+    in the database pool, so that prefetching never delays real requests.
+    """
+    executor = None
+    max_pending = 0
+    min_connections = 0
+    pending = 0
+    issued = 0
+    skipped = 0
+    hits = 0
+    # keys prefetched and not requested yet
+    _prefetched = OrderedDict()
+    _max_prefetched = 4096
+    _lock = Lock()
+
+    @classmethod
+    def init(cls, max_workers, min_connections=2):
+        cls.executor = ThreadPoolExecutor(max_workers)
+        cls.max_pending = 4 * max_workers
+        cls.min_connections = min_connections
+        cls.pending = cls.issued = cls.skipped = cls.hits = 0
+        cls._prefetched.clear()
+
+    @classmethod
+    def enabled(cls):
+        return cls.executor is not None
+
+    @classmethod
+    def submit(cls, key, func, *args):
+        '''
+        Run func(*args) in background unless the limits are reached.
+        Returns True if the prefetch is queued.
+        '''
+        with cls._lock:
+            if (cls.pending >= cls.max_pending or
+                    Session.available_connections() < cls.min_connections):
+                cls.skipped += 1
+                return False
+            cls.pending += 1
+            cls.issued += 1
+        cls.executor.submit(cls._run, key, func, args)
+        return True
+
+    @classmethod
+    def _run(cls, key, func, args):
+        try:
+            func(*args)
+            with cls._lock:
+                cls._prefetched[key] = None
+                if len(cls._prefetched) > cls._max_prefetched:
+                    cls._prefetched.popitem(last=False)
+        finally:
+            with cls._lock:
+                cls.pending -= 1
+
+    @classmethod
+    def hit(cls, key):
+        '''
+        Record that a cached entry has been requested
+        '''
+        with cls._lock:
+            if key in cls._prefetched:
+                del cls._prefetched[key]
+                cls.hits += 1
+
+    @classmethod
+    def stats(cls):
+        if cls.executor is None:
+            return {}
+        return {
+            'pending': cls.pending,
+            'issued': cls.issued,
+            'skipped': cls.skipped,
+            'hits': cls.hits,
+            'hit_ratio': cls.hits / cls.issued if cls.issued else 0,
+        }
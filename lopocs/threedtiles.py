@@ -1,25 +1,32 @@
 # -*- coding: utf-8 -*-
 import json
 import math
+from functools import lru_cache
+from urllib.parse import parse_qs, urlsplit
 
 import numpy as np
 from flask import make_response
 
-from py3dtiles.feature_table import (
-    FeatureTableHeader, FeatureTableBody, FeatureTable
-)
-from py3dtiles.pnts import PntsBody, PntsHeader, Pnts
-
 from .utils import (
-    read_uncompressed_patch, boundingbox_to_polygon, list_from_str, patch_numpoints
+    read_uncompressed_patch, list_from_str, schema_dtype
 )
 from .conf import Config
+from .colors import classification_palette
+from .pnts import encode_pnts
 from .database import Session
+from .octree import OCTANTS, split_bbox, sql_count_points, count_hierarchy
+from .cache import TilesetCache
+from .workers import LazWorkers
+from .singleflight import SingleFlight
 
 LOD_MIN = 0
 LOD_MAX = 5
 LOD_LEN = LOD_MAX + 1 - LOD_MIN
 
+# concurrent identical requests wait for a single computation
+read_flights = SingleFlight()
+tileset_flights = SingleFlight()
+
 
 def ThreeDTilesInfo(table, column):
 
@@ -27,8 +34,7 @@ def ThreeDTilesInfo(table, column):
     # bounding box
     box = session.boundingbox
 
-    # number of points for the first patch
-    npoints = session.approx_row_count * session.patch_size
+    npoints = session.numpoints
 
     # srs
     srs = session.srs
@@ -47,182 +53,260 @@ def ThreeDTilesRead(table, column, bounds, lod):
     session = Session(table, column)
     # offsets = [round(off, 2) for off in list_from_str(offsets)]
     box = list_from_str(bounds)
+    key = (table, column, tuple(round(b, 6) for b in box), lod)
+    tile = read_flights.do(key, get_tile, session, box, lod)
+
+    # build flask response
+    response = make_response(tile)
+    response.headers['content-type'] = 'application/octet-stream'
+    return response
+
+
+def tile_contents(tileset):
+    '''
+    Yields the (lod, bounds, content) of every tile of a tileset built by
+    build_tileset, content being the dict holding the url of the tile
+    '''
+    nodes = [tileset['root']]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get('children', []))
+        if 'content' not in node:
+            continue
+        query = parse_qs(urlsplit(node['content']['url']).query)
+        yield (int(query['lod'][0]), list_from_str(query['bounds'][0]),
+               node['content'])
+
+
+def ThreeDTilesTileset(table, column, bounds, lod):
+    '''
+    Returns a tileset covering Config.TILESET_LEVELS levels of detail from
+    the node at 'lod' and 'bounds' (the whole dataset by default)
+    '''
+    session = Session(table, column)
+    if bounds:
+        box = list_from_str(bounds)
+    else:
+        fullbbox = session.boundingbox
+        box = [
+            fullbbox['xmin'], fullbbox['ymin'], fullbbox['zmin'],
+            fullbbox['xmax'], fullbbox['ymax'], fullbbox['zmax']
+        ]
+    lod = lod or LOD_MIN
+
+    key = (table, column, tuple(round(b, 6) for b in box), lod)
+    tileset = TilesetCache.get(key)
+    if tileset is None:
+        tileset = tileset_flights.do(
+            key, get_cached_tileset, key, session, box, lod)
+
+    response = make_response(tileset)
+    response.headers['content-type'] = 'application/json'
+    return response
+
+
+def get_cached_tileset(key, session, box, lod):
+    tileset = json.dumps(
+        build_subtileset(session, box, lod), separators=(',', ':')).encode()
+    TilesetCache.put(key, tileset)
+    return tileset
+
+
+def geometric_error(session, lod):
+    '''
+    Geometric error of the tiles at 'lod', halved at each level like in
+    build_tileset
+    '''
+    bbox = session.boundingbox
+    diagonal = math.sqrt(
+        (bbox['xmax'] - bbox['xmin']) ** 2 +
+        (bbox['ymax'] - bbox['ymin']) ** 2 +
+        (bbox['zmax'] - bbox['zmin']) ** 2
+    )
+    return diagonal / 20 / 2 ** (lod - LOD_MIN)
+
+
+def tile_hierarchy(session, bbox, lod, lod_max):
+    '''
+    Returns the non-empty tiles under a tile as nested dicts like
+    assemble_hierarchy, computed as set by HIERARCHY_MODE
+    '''
+    return count_hierarchy(session, bbox, lod, lod_max, lod_range, sql_count)
+
+
+def build_subtileset(session, bbox, lod):
+    '''
+    Returns the tileset of a tile and its descendants down to
+    Config.TILESET_LEVELS levels. Non-empty tiles of the last level
+    are references to their own tileset.
+
+    Urls are relative to the tileset.json route.
+    '''
+    lod_max = min(lod + Config.TILESET_LEVELS, LOD_MAX)
+    hcy = tile_hierarchy(session, bbox, lod, lod_max)
+    root = subtileset_section(session, hcy, bbox, lod, lod_max) or {
+        "boundingVolume": {"box": buildbox(bbox)},
+        "geometricError": geometric_error(session, lod),
+    }
+    root["refine"] = "add"
+    if lod == LOD_MIN:
+        error = geometric_error(session, lod) * 20
+    else:
+        error = geometric_error(session, lod - 1)
+    return {
+        "asset": {"version": "0.0"},
+        "geometricError": error,
+        "root": root,
+    }
+
+
+def subtileset_section(session, hcy, bbox, lod, lod_max):
+    bounds = ("bounds=[{0},{1},{2},{3},{4},{5}]"
+              .format(bbox[0], bbox[1], bbox[2], bbox[3], bbox[4], bbox[5]))
+    section = {
+        "boundingVolume": {"box": buildbox(bbox)},
+        "geometricError": geometric_error(session, lod),
+    }
+
+    if lod == lod_max and lod < LOD_MAX:
+        # external tileset
+        section["content"] = {
+            "url": "tileset.json?lod={0}&{1}".format(lod, bounds)}
+        return section
+
+    if hcy.get('n', 0) > 0:
+        section["content"] = {
+            "url": "read.pnts?lod={0}&{1}".format(lod, bounds)}
+
+    children_list = []
+    for code, bb in zip(OCTANTS, split_bbox(bbox)):
+        if code in hcy:
+            children_list.append(subtileset_section(
+                session, hcy[code], bb, lod + 1, lod_max))
+    if children_list:
+        section["children"] = children_list
+    elif "content" not in section:
+        return None
+    return section
+
+
+def get_tile(session, box, lod):
+    '''
+    Returns the pnts tile of a node as bytes
+    '''
+    sql, parameters = sql_query(session, box, lod)
+    if Config.DEBUG:
+        print(sql, parameters)
+
+    pcpatch_wkb = session.query_patches(sql, parameters)[0][0]
+    return encode_tile(session, pcpatch_wkb)
+
+
+def encode_tile(session, pcpatch_wkb):
+    '''
+    Returns the pnts tile of the patch selected by sql_query
+    '''
     # requested = [scales, offsets]
     stored_patches = session.lopocstable.filter_stored_output()
     schema = stored_patches['point_schema']
-    pcid = stored_patches['pcid']
     # scales = [scale] * 3
     scales = stored_patches['scales']
     offsets = stored_patches['offsets']
 
-    [tile, npoints] = get_points(session, box, lod, offsets, pcid, scales, schema)
+    [tile, npoints] = get_points(
+        session, pcpatch_wkb, offsets, scales, schema)
 
     if Config.DEBUG:
-        tile.sync()
         print("NPOINTS: ", npoints)
 
-    # build flask response
-    response = make_response(tile.to_array().tostring())
-    response.headers['content-type'] = 'application/octet-stream'
-    return response
+    return tile
 
 
-def classification_to_rgb(points):
-    """
-    map LAS Classification to RGB colors.
-    See LAS spec for codes :
-    http://www.asprs.org/wp-content/uploads/2010/12/asprs_las_format_v11.pdf
-
-    :param points: points as a structured numpy array
-    :returns: numpy.record with dtype [('Red', 'u1'), ('Green', 'u1'), ('Blue', 'u1')])
-    """
-    # building (brown)
-    building_mask = (points['Classification'] == 6).astype(np.int)
-    red = building_mask * 186
-    green = building_mask * 79
-    blue = building_mask * 63
-    # high vegetation (green)
-    veget_mask = (points['Classification'] == 5).astype(np.int)
-    red += veget_mask * 140
-    green += veget_mask * 156
-    blue += veget_mask * 8
-    # medium vegetation
-    veget_mask = (points['Classification'] == 4).astype(np.int)
-    red += veget_mask * 171
-    green += veget_mask * 200
-    blue += veget_mask * 116
-    # low vegetation
-    veget_mask = (points['Classification'] == 3).astype(np.int)
-    red += veget_mask * 192
-    green += veget_mask * 213
-    blue += veget_mask * 160
-    # water (blue)
-    water_mask = (points['Classification'] == 9).astype(np.int)
-    red += water_mask * 141
-    green += water_mask * 179
-    blue += water_mask * 198
-    # ground (light brown)
-    grd_mask = (points['Classification'] == 2).astype(np.int)
-    red += grd_mask * 226
-    green += grd_mask * 230
-    blue += grd_mask * 229
-    # Unclassified (grey)
-    grd_mask = (points['Classification'] == 1).astype(np.int)
-    red += grd_mask * 176
-    green += grd_mask * 185
-    blue += grd_mask * 182
-
-    rgb_reduced = np.c_[red, green, blue]
-    rgb = np.array(np.core.records.fromarrays(rgb_reduced.T, dtype=cdt))
-    return rgb
-
-
-cdt = np.dtype([('Red', np.uint8), ('Green', np.uint8), ('Blue', np.uint8)])
-pdt = np.dtype([('X', np.float32), ('Y', np.float32), ('Z', np.float32)])
-
-
-def get_points(session, box, lod, offsets, pcid, scales, schema):
-    sql = sql_query(session, box, pcid, lod)
-    if Config.DEBUG:
-        print(sql)
-
-    pcpatch_wkb = session.query(sql)[0][0]
-    points, npoints = read_uncompressed_patch(pcpatch_wkb, schema)
-    fields = points.dtype.fields.keys()
-
-    if 'Red' in fields:
-        if max(points['Red']) > 255:
-            # normalize
-            rgb_reduced = np.c_[points['Red'] % 255, points['Green'] % 255, points['Blue'] % 255]
-            rgb = np.array(np.core.records.fromarrays(rgb_reduced.T, dtype=cdt))
-        else:
-            rgb = points[['Red', 'Green', 'Blue']].astype(cdt)
-    elif 'Classification' in fields:
-        rgb = classification_to_rgb(points)
-    else:
-        # No colors
-        # FIXME: compute color gradient based on elevation
-        rgb_reduced = np.zeros((npoints, 3), dtype=int)
-        rgb = np.array(np.core.records.fromarrays(rgb_reduced, dtype=cdt))
+@lru_cache(maxsize=1)
+def palette():
+    '''
+    Classification palette built once from CESIUM_PALETTE
+    '''
+    return classification_palette(Config.CESIUM_PALETTE)
 
-    quantized_points_r = np.c_[
-        points['X'] * scales[0],
-        points['Y'] * scales[1],
-        points['Z'] * scales[2]
-    ]
 
-    quantized_points = np.array(np.core.records.fromarrays(quantized_points_r.T, dtype=pdt))
+def get_points(session, pcpatch_wkb, offsets, scales, schema):
+    if Config.CESIUM_LAZ_TRANSPORT:
+        points = np.frombuffer(
+            LazWorkers.decompress(pcpatch_wkb, schema),
+            dtype=schema_dtype(schema))
+        npoints = len(points)
+    else:
+        points, npoints = read_uncompressed_patch(pcpatch_wkb, schema)
 
-    fth = FeatureTableHeader.from_dtype(
-        quantized_points.dtype, rgb.dtype, npoints
-    )
-    ftb = FeatureTableBody()
-    ftb.positions_itemsize = fth.positions_dtype.itemsize
-    ftb.colors_itemsize = fth.colors_dtype.itemsize
-    ftb.positions_arr = quantized_points.view(np.uint8)
-    ftb.colors_arr = rgb.view(np.uint8)
-
-    ft = FeatureTable()
-    ft.header = fth
-    ft.body = ftb
-
-    # tile
-    tb = PntsBody()
-    tb.feature_table = ft
-    th = PntsHeader()
-    tile = Pnts()
-    tile.body = tb
-    tile.header = th
-    tile.body.feature_table.header.rtc = offsets
+    tile = encode_pnts(
+        points, scales, offsets, session.lopocstable.dimensions, palette(),
+        quantize=Config.CESIUM_QUANTIZED)
 
     return [tile, npoints]
 
 
-def sql_query(session, box, pcid, lod):
-    poly = boundingbox_to_polygon(box)
-
+def lod_range(session, lod):
+    '''
+    Returns the first point and the number of points to select in each
+    patch for a given level of detail
+    '''
     maxppp = session.lopocstable.max_points_per_patch
-    # FIXME: need to be cached
-    patch_size = session.patch_size
-
     if maxppp:
-        range_min = 1
-        range_max = maxppp
+        return 1, maxppp
+
+    patch_size = session.patch_size
+    # FIXME: may skip some points if patch_size/lod_len is decimal
+    # we need to fix either here or at loading with the patch_size and lod bounds
+    range_min = lod * int(patch_size / LOD_LEN) + 1
+    range_max = (lod + 1) * int(patch_size / LOD_LEN)
+    return range_min, range_max
+
+
+def sql_count(session, box, lod):
+    '''
+    Returns the query and its parameters used to count the points of a tile
+    '''
+    range_min, range_max = lod_range(session, lod)
+    if Config.USE_MORTON:
+        zmin, zmax = box[2] - 0.1, box[5] + 0.1
     else:
-        # FIXME: may skip some points if patch_size/lod_len is decimal
-        # we need to fix either here or at loading with the patch_size and lod bounds
-        range_min = lod * int(patch_size / LOD_LEN) + 1
-        range_max = (lod + 1) * int(patch_size / LOD_LEN)
+        zmin, zmax = box[2], box[5]
+    return sql_count_points(session, box, range_min, range_max, zmin, zmax)
+
 
-    # build the sql query
-    sql_limit = ""
-    maxppq = session.lopocstable.max_patches_per_query
-    if maxppq:
-        sql_limit = " limit {0} ".format(maxppq)
+def sql_query(session, box, lod):
+    '''
+    Returns the query and its parameters used to get points of a tile,
+    compressed with lazperf if CESIUM_LAZ_TRANSPORT is set
+    '''
+    range_min, range_max = lod_range(session, lod)
+
+    maxppq = session.patches_limit
 
     if Config.USE_MORTON:
-        sql = ("select pc_union("
-               "pc_filterbetween( "
-               "pc_range({0}, {4}, {5}), 'Z', {6}, {7} )) from "
-               "(select {0} from {1} "
-               "where pc_intersects({0}, st_geomfromtext('polygon (("
-               "{2}))',{3})) order by morton {8})_;"
-               .format(session.column, session.table,
-                       poly, session.srsid, range_min, range_max,
-                       box[2] - 0.1, box[5] + 0.1, sql_limit,
-                       pcid))
+        zmin, zmax = box[2] - 0.1, box[5] + 0.1
+        order = "order by morton"
     else:
-        sql = ("select pc_compress(pc_transform(pc_union("
-               "pc_filterbetween( "
-               "pc_range({0}, {4}, {5}), 'Z', {6}, {7} )), {9}), 'laz') from "
-               "(select {0} from {1} where pc_intersects({0}, "
-               "st_geomfromtext('polygon (({2}))',{3})) {8})_;"
-               .format(session.column, session.table,
-                       poly, session.srsid, range_min, range_max,
-                       box[2], box[5], sql_limit,
-                       pcid))
+        zmin, zmax = box[2], box[5]
+        order = ""
+
+    union = ("pc_union(pc_filterbetween("
+             "pc_range({0}, %s, %s), 'Z', %s, %s))".format(session.column))
+    if Config.CESIUM_LAZ_TRANSPORT:
+        union = "pc_compress({0}, 'laz')".format(union)
+
+    sql = ("select {0} from "
+           "(select {1} from {2} "
+           "where pc_intersects({1}, st_makeenvelope(%s, %s, %s, %s, %s)) "
+           "{3} limit %s)_;"
+           .format(union, session.column, session.table, order))
+    parameters = (
+        range_min, range_max, zmin, zmax,
+        box[0], box[1], box[3], box[4], session.srsid, maxppq
+    )
 
-    return sql
+    return sql, parameters
 
 
 def buildbox(bbox):
@@ -247,9 +331,19 @@ def buildbox(bbox):
 
 
 def build_hierarchy_from_pg(session, baseurl, bbox):
+    '''
+    Returns the tileset of a resource as a json string
+    '''
+    tileset = build_tileset(session, baseurl, bbox)
+    return json.dumps(tileset, indent=2, separators=(',', ': '))
+
 
+def build_tileset(session, baseurl, bbox):
+    '''
+    Returns the tileset covering 'bbox' as a dict, tile urls
+    start with 'baseurl'
+    '''
     stored_patches = session.lopocstable.filter_stored_output()
-    pcid = stored_patches['pcid']
     offsets = stored_patches['offsets']
     tileset = {}
     tileset["asset"] = {"version": "0.0"}
@@ -281,21 +375,54 @@ def build_hierarchy_from_pg(session, baseurl, bbox):
     root["geometricError"] = GEOMETRIC_ERROR / 20
     root["content"] = {"url": url}
 
-    lod = 1
+    # non-empty tiles, found as set by HIERARCHY_MODE
+    hcy = tile_hierarchy(session, bbox, LOD_MIN, LOD_MAX)
     children_list = []
-    for bb in split_bbox(bbox):
-        json_children = children(
-            session, baseurl, offsets, bb, lod, pcid, GEOMETRIC_ERROR / 40
-        )
-        if len(json_children):
-            children_list.append(json_children)
+    for code, bb in zip(OCTANTS, split_bbox(bbox)):
+        if code in hcy:
+            json_children = hierarchy_to_tileset(
+                session, baseurl, offsets, hcy[code], bb, LOD_MIN + 1,
+                GEOMETRIC_ERROR / 40)
+            if len(json_children):
+                children_list.append(json_children)
 
     if len(children_list):
         root["children"] = children_list
 
     tileset["root"] = root
 
-    return json.dumps(tileset, indent=2, separators=(',', ': '))
+    return tileset
+
+
+def hierarchy_to_tileset(session, baseurl, offsets, hcy, bbox, lod, err):
+    '''
+    Convert a node of a hierarchy built by assemble_hierarchy to a tileset
+    section, bounding boxes are split like in OctreeWalker. Returns an empty
+    dict if the node and its children are empty.
+    '''
+    # required on every tile, even without content
+    json_me = {
+        "boundingVolume": {"box": buildbox(bbox)},
+        "geometricError": err,
+    }
+    if hcy.get('n', 0) > 0:
+        json_me = build_children_section(
+            session, baseurl, offsets, bbox, err, lod)
+
+    children_list = []
+    for code, bb in zip(OCTANTS, split_bbox(bbox)):
+        if code in hcy:
+            json_children = hierarchy_to_tileset(
+                session, baseurl, offsets, hcy[code], bb, lod + 1, err / 2)
+            if len(json_children):
+                children_list.append(json_children)
+
+    if len(children_list):
+        json_me["children"] = children_list
+    elif "content" not in json_me:
+        return {}
+
+    return json_me
 
 
 def build_children_section(session, baseurl, offsets, bbox, err, lod):
@@ -318,58 +445,3 @@ def build_children_section(session, baseurl, offsets, bbox, err, lod):
     cjson["content"] = {"url": url}
 
     return cjson
-
-
-def split_bbox(bbox):
-    width = bbox[3] - bbox[0]
-    length = bbox[4] - bbox[1]
-    height = bbox[5] - bbox[2]
-
-    up = bbox[5]
-    middle = up - height / 2
-    down = bbox[2]
-
-    x = bbox[0]
-    y = bbox[1]
-
-    bbox_nwd = [x, y + length / 2, down, x + width / 2, y + length, middle]
-    bbox_nwu = [x, y + length / 2, middle, x + width / 2, y + length, up]
-    bbox_ned = [x + width / 2, y + length / 2, down, x + width, y + length, middle]
-    bbox_neu = [x + width / 2, y + length / 2, middle, x + width, y + length, up]
-    bbox_swd = [x, y, down, x + width / 2, y + length / 2, middle]
-    bbox_swu = [x, y, middle, x + width / 2, y + length / 2, up]
-    bbox_sed = [x + width / 2, y, down, x + width, y + length / 2, middle]
-    bbox_seu = [x + width / 2, y, middle, x + width, y + length / 2, up]
-
-    return [bbox_nwd, bbox_nwu, bbox_ned, bbox_neu, bbox_swd, bbox_swu,
-            bbox_sed, bbox_seu]
-
-
-def children(session, baseurl, offsets, bbox, lod, pcid, err):
-
-    # run sql
-    sql = sql_query(session, bbox, pcid, lod)
-    pcpatch_wkb = session.query(sql)[0][0]
-
-    json_me = {}
-    if lod <= LOD_MAX and pcpatch_wkb:
-        npoints = patch_numpoints(pcpatch_wkb)
-        if npoints > 0:
-            json_me = build_children_section(session, baseurl, offsets, bbox, err, lod)
-
-        lod += 1
-
-        children_list = []
-        if lod <= LOD_MAX:
-            for bb in split_bbox(bbox):
-                json_children = children(
-                    session, baseurl, offsets, bb, lod, pcid, err / 2
-                )
-
-                if len(json_children):
-                    children_list.append(json_children)
-
-        if len(children_list):
-            json_me["children"] = children_list
-
-    return json_me
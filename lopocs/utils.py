@@ -1,13 +1,13 @@
 # -*- coding: utf-8 -*-
 import json
 import math
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 from binascii import unhexlify
 import os
 import decimal
 
 import numpy as np
-from lazperf import buildNumpyDescription, Decompressor
+from lazperf import buildNumpyDescription, Compressor, Decompressor
 
 from .conf import Config
 
@@ -37,6 +37,39 @@ def schema_dtype(schema):
         {'names': [dim['name'] for dim in schema], 'formats': formats})
 
 
+def transform_points(points, scales, offsets, schema, out_scales, out_offsets):
+    '''
+    Convert points to another greyhound like schema the way pc_transform
+    does: dimensions are reordered, dropped or cast, X/Y/Z are rescaled and
+    re-offset and dimensions missing from 'points' are filled with 0.
+
+    :param points: structured numpy array
+    :param scales: scales of X/Y/Z dimensions in 'points'
+    :param offsets: offsets of X/Y/Z dimensions in 'points'
+    :returns: structured numpy array with a dtype built from 'schema'
+    '''
+    out_dtype = schema_dtype(schema)
+    out = np.zeros(len(points), dtype=out_dtype)
+    fields = points.dtype.fields
+
+    for dim in schema:
+        name = dim['name']
+        if name not in fields:
+            continue
+        axis = 'XYZ'.find(name)
+        if axis < 0 or (scales[axis] == out_scales[axis] and
+                        offsets[axis] == out_offsets[axis]):
+            out[name] = points[name]
+            continue
+        coords = points[name] * scales[axis] + (offsets[axis] - out_offsets[axis])
+        if dim['type'] == 'floating':
+            out[name] = coords / out_scales[axis]
+        else:
+            out[name] = np.round(coords / out_scales[axis])
+
+    return out
+
+
 def read_uncompressed_patch(pcpatch_wkb, schema):
     '''
     Patch binary structure uncompressed:
@@ -46,10 +79,10 @@ def read_uncompressed_patch(pcpatch_wkb, schema):
     uint32:       npoints
     pointdata[]:  interpret relative to pcid
     '''
-    patchbin = unhexlify(pcpatch_wkb)
-    npoints = unpack("I", patchbin[9:13])[0]
+    patchbin = patch_bytes(pcpatch_wkb)
+    npoints = unpack_from("I", patchbin, 9)[0]
     dt = schema_dtype(schema)
-    patch = np.fromstring(patchbin[13:], dtype=dt)
+    patch = np.frombuffer(patchbin, dtype=dt, offset=13)
     # debug
     # print(patch[:10])
     return patch, npoints
@@ -58,12 +91,12 @@ def read_uncompressed_patch(pcpatch_wkb, schema):
 def decompress(points, schema):
     """
     Decode patch encoded with lazperf.
-    'points' is a pcpatch in wkb
+    'points' is a pcpatch in wkb (hex string or bytes)
     """
 
     # retrieve number of points in wkb pgpointcloud patch
     npoints = patch_numpoints(points)
-    hexbuffer = unhexlify(points[34:])
+    hexbuffer = bytes(patch_bytes(points)[17:])
     hexbuffer += hexa_signed_int32(npoints)
 
     # uncompress
@@ -79,6 +112,18 @@ def decompress(points, schema):
     return decompressed
 
 
+def compress(points, schema):
+    """
+    Encode points with lazperf.
+    'points' is a buffer of uncompressed points described by 'schema'
+    """
+    s = json.dumps(schema)
+    dtype = buildNumpyDescription(json.loads(s))
+    arr = np.frombuffer(points, dtype=dtype)
+    c = Compressor(s)
+    return c.compress(arr).tobytes()
+
+
 def compute_scale_for_cesium(coordmin, coordmax):
     '''
     Cesium quantized positions need to be in uint16
@@ -102,15 +147,6 @@ def greyhound_types(typ):
     return "signed"
 
 
-def write_in_cache(d, filename):
-    path = os.path.join(Config.CACHE_DIR, filename)
-    if not os.path.exists(Config.CACHE_DIR):
-        os.mkdir(Config.CACHE_DIR)
-    f = open(path, 'w')
-    f.write(json.dumps(d))
-    f.close()
-
-
 def read_in_cache(filename):
     path = os.path.join(Config.CACHE_DIR, filename)
 
@@ -153,6 +189,18 @@ def boundingbox_to_polygon(box):
     return boxstr
 
 
+def pg_placeholders(query):
+    """
+    Replace psycopg2 '%s' placeholders by the positional parameters '$1',
+    '$2', ... used by postgresql prepared statements
+    """
+    parts = query.split('%s')
+    sql = parts[0]
+    for idx, part in enumerate(parts[1:], 1):
+        sql += '${}{}'.format(idx, part)
+    return sql
+
+
 def list_from_str_box(box_str):
     """
     Transform a string 'BOX(xmin, ymin, xmax, ymax)' to
@@ -182,5 +230,52 @@ def hexa_signed_uint8(val):
 def patch_numpoints(pcpatch_wkb):
     '''get number of points in a patch
     '''
-    npoints_hexa = pcpatch_wkb[18:26]
-    return unpack("I", unhexlify(npoints_hexa))[0]
+    if isinstance(pcpatch_wkb, str):
+        npoints_hexa = pcpatch_wkb[18:26]
+        return unpack("I", unhexlify(npoints_hexa))[0]
+    return unpack_from("I", pcpatch_wkb, 9)[0]
+
+
+def patch_bytes(pcpatch_wkb):
+    '''
+    Returns a bytes-like object for a patch coming either as hex wkb
+    (default text transport) or as binary (bytea transport)
+    '''
+    if isinstance(pcpatch_wkb, str):
+        return unhexlify(pcpatch_wkb)
+    return memoryview(pcpatch_wkb)
+
+
+COPY_BINARY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+
+def copy_binary_rows(buf):
+    '''
+    Parse the output of a "COPY ... TO STDOUT WITH (FORMAT binary)"
+    https://www.postgresql.org/docs/current/static/sql-copy.html
+
+    Returns a list of tuples of memoryviews (None for null values)
+    pointing into ``buf``, no data is copied.
+    '''
+    buf = memoryview(buf)
+    if bytes(buf[:11]) != COPY_BINARY_SIGNATURE:
+        raise ValueError('not a binary copy stream')
+    # skip flags field and header extension
+    pos = 19 + unpack_from('!i', buf, 15)[0]
+    rows = []
+    while True:
+        nfields = unpack_from('!h', buf, pos)[0]
+        pos += 2
+        if nfields == -1:
+            break
+        row = []
+        for _ in range(nfields):
+            size = unpack_from('!i', buf, pos)[0]
+            pos += 4
+            if size == -1:
+                row.append(None)
+                continue
+            row.append(buf[pos:pos + size])
+            pos += size
+        rows.append(tuple(row))
+    return rows
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count, current_process
+
+from .utils import compress, decompress
+
+
+class LazWorkers():
+    """
+    Pool of processes used to encode and decode points with lazperf
+    outside of the database
+    """
+    executor = None
+
+    @classmethod
+    def init(cls, max_workers=None):
+        if current_process().daemon:
+            # daemonic processes (export-3dtiles workers) are not allowed
+            # to have children: points are encoded and decoded inline
+            cls.executor = None
+            return
+        cls.executor = ProcessPoolExecutor(max_workers or cpu_count())
+
+    @classmethod
+    def compress(cls, points, schema):
+        if cls.executor is None:
+            return compress(points, schema)
+        return cls.executor.submit(compress, bytes(points), schema).result()
+
+    @classmethod
+    def decompress(cls, points, schema):
+        if cls.executor is None:
+            return decompress(points, schema)
+        if not isinstance(points, str):
+            points = bytes(points)
+        return cls.executor.submit(decompress, points, schema).result()
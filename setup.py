@@ -19,7 +19,6 @@ requirements = (
     'pyyaml==5.2',
     'pygdal >= {0}, <{1}'.format(GDAL_MIN, GDAL_MAX),
     'redis==2.10.5',
-    'py3dtiles==1.0.2',
     'click==6.7',
     'requests==2.20.0',
     'lazperf==1.2.1',
@@ -44,6 +43,11 @@ prod_requirements = (
     'uwsgi'
 )
 
+async_requirements = (
+    'aiohttp>=3.0',
+    'asyncpg>=0.15',
+)
+
 
 def find_version(*file_paths):
     """
@@ -84,7 +88,8 @@ setup(
     extras_require={
         'dev': dev_requirements,
         'prod': prod_requirements,
-        'doc': doc_requirements
+        'doc': doc_requirements,
+        'async': async_requirements,
     },
     entry_points={
         'console_scripts': ['lopocs = lopocs.cli:cli'],
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('asyncpg')
+
+from lopocs.aio import AsyncSingleFlight  # noqa: E402
+
+
+def test_async_single_flight_coalesce():
+    flights = AsyncSingleFlight()
+    calls = []
+
+    async def compute(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value * 2
+
+    async def run():
+        return await asyncio.gather(
+            *[flights.do('k', compute, 21) for _ in range(4)])
+
+    results = asyncio.get_event_loop().run_until_complete(run())
+    assert results == [42] * 4
+    assert calls == [21]
+    assert flights.stats() == {'calls': 1, 'coalesced': 3, 'inflight': 0}
+
+
+def test_async_single_flight_error():
+    flights = AsyncSingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError('boom')
+
+    async def run():
+        return await asyncio.gather(
+            flights.do('k', fail), flights.do('k', fail),
+            return_exceptions=True)
+
+    results = asyncio.get_event_loop().run_until_complete(run())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert flights.stats()['inflight'] == 0
@@ -0,0 +1,58 @@
+import os
+
+from lopocs.cache import LRUCache, HierarchyCache
+
+
+def test_lru_cache_hit_miss():
+    cache = LRUCache(10)
+    assert cache.get('a') is None
+    cache.put('a', b'1234')
+    assert cache.get('a') == b'1234'
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['bytes'] == 4
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(10)
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    # 'a' becomes the most recently used
+    cache.get('a')
+    cache.put('c', b'1234')
+    assert 'b' not in cache
+    assert 'a' in cache
+    assert 'c' in cache
+    assert cache.stats()['evictions'] == 1
+    assert cache.nbytes == 8
+
+
+def test_lru_cache_too_big():
+    cache = LRUCache(10)
+    assert not cache.put('a', b'x' * 11)
+    assert len(cache) == 0
+
+
+def test_hierarchy_cache(tmpdir):
+    HierarchyCache.init(str(tmpdir), 1024)
+    hcy = {'n': 10, 'swd': {'n': 4}}
+    key = HierarchyCache.key('table', 'points', 0, 2, [0, 0, 0, 1, 1, 1])
+    assert HierarchyCache.get(key) is None
+    HierarchyCache.put(key, hcy)
+    assert HierarchyCache.get(key) == hcy
+    assert tmpdir.join(key + HierarchyCache.suffix).check()
+
+    # a new process only finds it on disk
+    HierarchyCache.init(str(tmpdir), 1024)
+    assert HierarchyCache.get(key) == hcy
+    assert HierarchyCache.stats()['disk']['hits'] == 1
+
+
+def test_hierarchy_cache_disk_eviction(tmpdir):
+    HierarchyCache.init(str(tmpdir), 1024, disk_maxbytes=10)
+    HierarchyCache.put('first', {'n': 1})
+    os.utime(HierarchyCache.path('first'), (0, 0))
+    HierarchyCache.put('second', {'n': 2})
+    assert [f.basename for f in tmpdir.listdir()] == ['second.hcyb']
+    assert HierarchyCache.stats()['disk']['evictions'] == 1
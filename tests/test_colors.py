@@ -0,0 +1,36 @@
+import numpy as np
+
+from lopocs.colors import cdt, classification_palette, colorize
+
+
+def test_classification_palette():
+    palette = classification_palette({'6': [255, 0, 0]})
+    assert palette.shape == (256, 3)
+    assert list(palette[2]) == [226, 230, 229]
+    assert list(palette[6]) == [255, 0, 0]
+    assert list(palette[42]) == [0, 0, 0]
+
+
+def test_colorize_classification():
+    points = np.array([(2,), (6,), (200,)], dtype=[('Classification', 'u1')])
+    rgb = colorize(points, {}, classification_palette())
+    assert rgb.dtype == cdt
+    assert rgb.tolist() == [(226, 230, 229), (186, 79, 63), (0, 0, 0)]
+
+
+def test_colorize_16bits():
+    dtype = [('Red', 'u2'), ('Green', 'u2'), ('Blue', 'u2')]
+    points = np.array([(65535, 256, 0)], dtype=dtype)
+    dimensions = {'Red': [0, 65535], 'Green': [0, 65535], 'Blue': [0, 300]}
+    rgb = colorize(points, dimensions, None)
+    assert rgb.tolist() == [(255, 1, 0)]
+
+    # 8 bits colors stored on 16 bits, ranges computed from the points
+    points = np.array([(255, 128, 0)], dtype=dtype)
+    assert colorize(points, {}, None).tolist() == [(255, 128, 0)]
+
+
+def test_colorize_intensity():
+    points = np.array([(100,), (300,), (500,)], dtype=[('Intensity', 'u2')])
+    rgb = colorize(points, {'Intensity': [100, 500]}, None)
+    assert [color[0] for color in rgb.tolist()] == [0, 127, 255]
@@ -0,0 +1,132 @@
+import json
+from decimal import Decimal
+
+from lopocs.database import LOPOCS_VERSIONED_QUERY, LopocsTable, Session
+
+
+def test_cached_metadata(monkeypatch):
+    queries = []
+
+    def query(cls, sql, parameters=None):
+        queries.append(sql)
+        return [[400]]
+
+    monkeypatch.setattr(Session, 'query', classmethod(query))
+    monkeypatch.setattr(Session, 'catalog', {
+        ('public.t', 'points'): LopocsTable(
+            'public.t', 'points', 4326, 1, [], 4096, None, {})
+    })
+    session = Session('public.t', 'points')
+
+    assert session.patch_size == 400
+    assert session.patch_size == 400
+    assert session.approx_row_count == 400
+    assert len(queries) == 2
+
+    Session.invalidate('public.t', 'points')
+    assert session.patch_size == 400
+    assert len(queries) == 3
+
+
+def test_refresh_catalog(monkeypatch):
+    state = {'generation': 1, 'loads': 0}
+    row = ['public.t', 'points', 4326, 1, [1], [[0.01] * 3], [[0] * 3],
+           [''], [[0] * 6], [False], 4096, None, None, {}, 10]
+
+    def query(cls, sql, parameters=None):
+        if sql == LOPOCS_VERSIONED_QUERY:
+            return [[True]]
+        if 'pointcloud_lopocs_generation' in sql:
+            return [[state['generation']]]
+        state['loads'] += 1
+        return [row]
+
+    monkeypatch.setattr(Session, 'query', classmethod(query))
+    Session.clear_catalog()
+
+    Session.refresh_catalog()
+    catalog = Session.catalog
+    assert Session.generation == 1
+    assert ('public.t', 'points') in catalog
+
+    # unchanged generation: no reload
+    Session.refresh_catalog()
+    assert state['loads'] == 1
+
+    # the previous snapshot is left untouched by a reload
+    state['generation'] = 2
+    Session.refresh_catalog()
+    assert state['loads'] == 2
+    assert Session.generation == 2
+    assert Session.catalog is not catalog
+    assert ('public.t', 'points') in catalog
+
+    Session.clear_catalog()
+
+
+def test_catalog_not_versioned(monkeypatch):
+    row = ['public.t', 'points', 4326, 1, [1], [[0.01] * 3], [[0] * 3],
+           [''], [[0] * 6], [False], 4096, None, None, {}, 10]
+
+    def query(cls, sql, parameters=None):
+        # metadata tables created before the generation sequence
+        if sql == LOPOCS_VERSIONED_QUERY:
+            return [[False]]
+        if 'pointcloud_lopocs_generation' in sql:
+            raise AssertionError('relation does not exist')
+        return [row]
+
+    monkeypatch.setattr(Session, 'query', classmethod(query))
+    Session.clear_catalog()
+
+    Session.refresh_catalog()
+    assert Session.generation == 0
+    assert ('public.t', 'points') in Session.catalog
+    Session.refresh_catalog()
+    assert Session.generation == 0
+
+    Session.clear_catalog()
+
+
+def test_numpoints(monkeypatch):
+    monkeypatch.setattr(Session, 'query', classmethod(
+        lambda cls, sql, parameters=None: [[4]]))
+    monkeypatch.setattr(Session, 'catalog', {
+        ('public.t', 'points'): LopocsTable(
+            'public.t', 'points', 4326, 1, [], 4096, None, {}),
+        ('public.u', 'points'): LopocsTable(
+            'public.u', 'points', 4326, 1, [], 4096, None, {}, numpoints=10),
+    })
+    # estimated from the row count and the patch size
+    assert Session('public.t', 'points').numpoints == 16
+    assert Session('public.u', 'points').numpoints == 10
+
+
+def test_compute_statistics(monkeypatch):
+    def query(cls, sql, parameters=None):
+        assert sql.count('pc_patchmin') == 3
+        assert parameters == ['X', 'X', 'y', 'y', 'Z', 'Z']
+        return [[Decimal(100)] + [Decimal(v) for v in range(1, 7)]]
+
+    monkeypatch.setattr(Session, 'query', classmethod(query))
+    numpoints, dimensions = Session.compute_statistics(
+        'public.t', 'points', ['X', 'y', 'Z'])
+    assert numpoints == 100
+    assert dimensions == {'X': [1, 2], 'y': [3, 4], 'Z': [5, 6]}
+    assert all(isinstance(v, float) for rng in dimensions.values() for v in rng)
+    json.dumps(dimensions)
+    assert Session.dimensions_boundingbox(dimensions) == {
+        'xmin': 1, 'xmax': 2, 'ymin': 3, 'ymax': 4, 'zmin': 5, 'zmax': 6}
+    assert Session.dimensions_boundingbox({'X': [1, 2]}) is None
+
+
+def test_patches_limit(monkeypatch):
+    monkeypatch.setattr(Session, 'catalog', {
+        ('public.t', 'points'): LopocsTable(
+            'public.t', 'points', 4326, 1, [], 4096, None, {}),
+        ('public.u', 'points'): LopocsTable(
+            'public.u', 'points', 4326, 1, [], 0, None, {}),
+    })
+    assert Session('public.t', 'points').patches_limit == 4096
+    # no limit
+    assert Session('public.u', 'points').patches_limit is None
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import pytest
+
+from lopocs import greyhound
+from lopocs.conf import Config
+from lopocs.greyhound import new_output, outputs
+from lopocs.pool import PoolTimeout
+
+
+def test_app_outputs_outlive_catalog(monkeypatch):
+    monkeypatch.setattr(Config, 'TRANSFORM_IN_APP', True)
+    monkeypatch.setattr(greyhound, 'app_outputs', {})
+    stored = {'scales': [0.01] * 3, 'offsets': [0, 0, 0], 'pcid': 1,
+              'point_schema': [], 'stored': True}
+    lopocstable = SimpleNamespace(outputs=[stored], bbox={
+        'xmin': 0, 'ymin': 0, 'zmin': 0, 'xmax': 1, 'ymax': 1, 'zmax': 1})
+    session = SimpleNamespace(
+        table='public.t', column='points', lopocstable=lopocstable)
+
+    output = new_output(session, [0.1] * 3, [0, 0, 0], [{'name': 'X'}])
+    assert output['pcid'] is None
+    assert output['bbox'] == [0, 0, 0, 10, 10, 10]
+    assert outputs(session) == [stored, output]
+
+    # a catalog reload gives a new entry with the stored outputs only
+    session.lopocstable = SimpleNamespace(outputs=[stored])
+    assert outputs(session) == [stored, output]
+
+
+def test_stream_error_before_response(monkeypatch):
+    monkeypatch.setattr(Config, 'STREAM_READS', True)
+
+    def stream(sql, parameters, size, buffer):
+        raise PoolTimeout('no connection available after 0s')
+        yield
+
+    session = SimpleNamespace(stream=stream, patches_limit=None, srsid=4326,
+                              table='public.t', column='points')
+    monkeypatch.setattr(greyhound, 'Session', lambda table, column: session)
+    monkeypatch.setattr(greyhound, 'read_parameters', lambda *args: (
+        [0, 0, 0, 1, 1, 1], {'pcid': 1, 'stored': True}, 0))
+    monkeypatch.setattr(greyhound, 'cached_points', lambda key: None)
+    monkeypatch.setattr(greyhound, 'lod_range', lambda session, lod: (1, 10))
+
+    # raised to the client (503) instead of a truncated 200 response
+    with pytest.raises(PoolTimeout):
+        greyhound.GreyhoundRead(
+            'public.t', 'points', None, None, None, 0, None, None, '[]', False)
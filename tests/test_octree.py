@@ -0,0 +1,168 @@
+import math
+from types import SimpleNamespace
+
+from lopocs import octree
+
+
+def test_split_bbox():
+    children = octree.split_bbox([0, 0, 0, 2, 4, 8])
+    assert len(children) == len(octree.OCTANTS)
+    nwd = children[octree.OCTANTS.index('nwd')]
+    assert nwd == [0, 2, 0, 1, 4, 4]
+    seu = children[octree.OCTANTS.index('seu')]
+    assert seu == [1, 0, 4, 2, 2, 8]
+
+
+def test_octant_offset():
+    assert octree.octant_offset('nwd') == (0, 1, 0)
+    assert octree.octant_offset('seu') == (1, 0, 1)
+
+
+def test_assemble_hierarchy():
+    counts = {
+        (0, 0, 0, 0): 10,
+        (1, 1, 0, 1): 5,
+        (2, 0, 3, 0): 2,
+    }
+    hcy = octree.assemble_hierarchy(counts, 2)
+    assert hcy['n'] == 10
+    assert hcy['seu'] == {'n': 5}
+    # (2, 0, 3, 0) has no count at depth 1 but is still reachable
+    assert hcy['nwd'] == {'nwd': {'n': 2}}
+    assert set(hcy) == {'n', 'seu', 'nwd'}
+
+
+def test_assemble_hierarchy_depth_max():
+    counts = {(0, 0, 0, 0): 10, (1, 0, 0, 0): 5}
+    assert octree.assemble_hierarchy(counts, 0) == {'n': 10}
+
+
+def test_hierarchy_counts():
+    hcy = {'n': 10, 'seu': {'n': 5}, 'nwd': {'nwd': {'n': 2}, 'n': 0}}
+    counts = octree.hierarchy_counts(hcy)
+    assert counts == {
+        (0, 0, 0, 0): 10,
+        (1, 1, 0, 1): 5,
+        (1, 0, 1, 0): 0,
+        (2, 0, 3, 0): 2,
+    }
+    assert octree.assemble_hierarchy(counts, 2) == hcy
+
+
+def test_octree_walker():
+    visited = []
+
+    def visit(bbox, lod):
+        visited.append(lod)
+        # only the 'swd' child of each node is not empty
+        return lod, bbox[:3] == [0, 0, 0]
+
+    walker = octree.OctreeWalker(visit, max_workers=4, max_pending=2)
+    root = walker.walk([([0, 0, 0, 8, 8, 8], 0)], 3)[0]
+    assert root.value == 0
+    assert len(root.children) == 8
+    # 1 root + 8 children at each level below a non-empty node
+    assert len(visited) == 1 + 8 * 3
+    swd = octree.OCTANTS.index('swd')
+    assert root.children[swd].children[swd].children[swd].value == 3
+    assert root.children[swd].children[swd].children[swd].children is None
+    assert root.children[0].children is None
+
+
+def test_octree_walker_error():
+    def visit(bbox, lod):
+        raise ValueError('boom')
+
+    walker = octree.OctreeWalker(visit, max_workers=2)
+    try:
+        walker.walk([([0, 0, 0, 1, 1, 1], 0)], 2)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_encode_hierarchy():
+    hcy = {
+        'n': 300,
+        'nwd': {'n': 0},
+        'seu': {'swu': {'n': 2 ** 40}},
+    }
+    encoded = octree.encode_hierarchy(hcy)
+    assert octree.decode_hierarchy(encoded) == hcy
+    assert octree.decode_hierarchy(octree.encode_hierarchy({})) == {}
+
+
+def test_sample_counts():
+    box = [0, 0, 0, 2, 2, 2]
+    # 1 point at depth 0, 4 at depth 1
+    ranges = [(1, 1), (2, 4)]
+    patches = [(0.5, 0.5, 0.5, 3), (1.5, 1.5, 1.5, 10), (2, 2, 2, 10)]
+    counts = octree.sample_counts(patches, box, ranges, 10)
+    assert counts == {
+        (0, 0, 0, 0): 30,
+        (1, 0, 0, 0): 20,
+        (1, 1, 1, 1): 80,
+    }
+
+
+def cell_index(value, origin, size, imax):
+    # evaluates octree.grid_index with python counterparts of its functions
+    sql = octree.grid_index('value', 'origin', 'size').replace('::integer', '')
+    return eval(sql, {
+        'least': min, 'greatest': max, 'floor': math.floor,
+        'coalesce': lambda v, default: v, 'nullif': lambda v, null: v,
+        'value': value, 'origin': origin, 'size': size, 'imax': imax,
+    })
+
+
+def test_sql_grid_counts():
+    session = SimpleNamespace(
+        column='points', table='public.t', srsid=4326, patches_limit=None)
+    sql, parameters = octree.sql_grid_counts(session, [0, 0, 0, 4, 4, 40], 1, 1, 10)
+    assert sql.count('%s') == len(parameters)
+    # grid origin, cell sizes and last index
+    assert parameters[:7] == (0, 0, 0, 2, 2, 20, 1)
+    # points are filtered on the Z range of each cell
+    assert 'z0 + iz * sz, z0 + (iz + 1) * sz' in sql
+
+    # a patch with z in [0, 30] is counted in both Z cells
+    assert cell_index(0, 0, 20, 1) == 0
+    assert cell_index(30, 0, 20, 1) == 1
+    # clamped to the grid
+    assert cell_index(-5, 0, 20, 1) == 0
+    assert cell_index(50, 0, 20, 1) == 1
+
+
+class FakeSession():
+    '''
+    Session whose patches hold 5 points in the south west down cell of
+    every level
+    '''
+    class pool:
+        maxconn = 2
+
+    def query_prepared(self, sql, parameters):
+        if sql == 'grid':
+            return [(0, 0, 0, 5)]
+        # count of a node, null if no patch intersects it
+        bbox = parameters
+        return [[5 if bbox[0] == 0 and bbox[1] == 0 and bbox[2] == 0 else None]]
+
+
+def test_count_hierarchy(monkeypatch):
+    session = FakeSession()
+    box = [0, 0, 0, 4, 4, 4]
+    monkeypatch.setattr(octree, 'sql_grid_counts', lambda *args: ('grid', ()))
+
+    def sql_count(session, bbox, lod):
+        return 'count', bbox
+
+    def lod_range(session, lod):
+        return 1, 10
+
+    expected = {'n': 5, 'swd': {'n': 5, 'swd': {'n': 5}}}
+    for mode in ('grouped', 'recursive'):
+        monkeypatch.setattr(octree.Config, 'HIERARCHY_MODE', mode)
+        assert octree.count_hierarchy(
+            session, box, 0, 2, lod_range, sql_count) == expected
@@ -0,0 +1,54 @@
+import json
+from struct import unpack_from
+
+import numpy as np
+
+from lopocs.colors import classification_palette
+from lopocs.pnts import encode_pnts
+
+dtype = np.dtype([('X', 'i4'), ('Y', 'i4'), ('Z', 'i4'), ('Classification', 'u1')])
+
+
+def parse(tile):
+    magic, version, length, json_size, bin_size, _, _ = unpack_from('<4s6I', tile)
+    assert magic == b'pnts'
+    assert version == 1
+    assert length == len(tile)
+    assert (28 + json_size) % 8 == 0
+    assert bin_size % 8 == 0
+    feature_table = json.loads(tile[28:28 + json_size].decode())
+    return feature_table, tile[28 + json_size:]
+
+
+def test_encode_pnts_quantized():
+    points = np.array([(0, 10, 65535, 2), (3, 4, 5, 6)], dtype=dtype)
+    tile = encode_pnts(points, [0.01] * 3, [100, 200, 300], {},
+                       classification_palette())
+    ft, body = parse(tile)
+    assert ft['POINTS_LENGTH'] == 2
+    assert ft['QUANTIZED_VOLUME_OFFSET'] == [100, 200, 300]
+    assert ft['QUANTIZED_VOLUME_SCALE'] == [0.01 * 65535] * 3
+    positions = np.frombuffer(body, dtype=np.uint16, count=6)
+    assert positions.tolist() == [0, 10, 65535, 3, 4, 5]
+    assert ft['RGB']['byteOffset'] % 8 == 0
+    colors = np.frombuffer(body, dtype=np.uint8, count=6,
+                           offset=ft['RGB']['byteOffset'])
+    assert colors.tolist() == [226, 230, 229, 186, 79, 63]
+
+
+def test_encode_pnts_float():
+    points = np.array([(-2, 10, 70000, 1)], dtype=dtype)
+    tile = encode_pnts(points, [0.5] * 3, [1, 2, 3], {},
+                       classification_palette())
+    ft, body = parse(tile)
+    assert 'POSITION_QUANTIZED' not in ft
+    assert ft['RTC_CENTER'] == [1, 2, 3]
+    positions = np.frombuffer(body, dtype=np.float32, count=3)
+    assert positions.tolist() == [-1, 5, 35000]
+
+
+def test_encode_pnts_empty():
+    tile = encode_pnts(np.zeros(0, dtype=dtype), [1] * 3, [0] * 3)
+    ft, body = parse(tile)
+    assert ft['POINTS_LENGTH'] == 0
+    assert len(body) == 0
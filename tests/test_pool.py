@@ -0,0 +1,132 @@
+from threading import Thread
+
+import psycopg2
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+from lopocs import greyhound
+from lopocs.cache import LRUCache, TileCache
+from lopocs.database import LopocsTable, Session
+from lopocs.pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection():
+
+    def __init__(self, dsn, **kwargs):
+        self.options = kwargs.get('options')
+        self.closed = 0
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(psycopg2, 'connect', FakeConnection)
+    return ConnectionPool(1, 2, 'dbname=test', timeout=0.05,
+                          statement_timeout=1000)
+
+
+def test_pool_reuse(pool):
+    conn = pool.getconn()
+    assert conn.options == '-c statement_timeout=1000'
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert pool.stats()['in_use'] == 1
+
+
+def test_pool_timeout(pool):
+    pool.getconn()
+    pool.getconn()
+    assert pool.available() == 0
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_pool_wait(pool):
+    first = pool.getconn()
+    pool.getconn()
+    acquired = []
+    thread = Thread(target=lambda: acquired.append(pool.getconn(timeout=5)))
+    thread.start()
+    pool.putconn(first)
+    thread.join()
+    assert acquired == [first]
+
+
+def test_pool_broken(pool):
+    conn = pool.getconn()
+    conn.status = TRANSACTION_STATUS_UNKNOWN
+    pool.putconn(conn)
+    assert conn.closed
+    assert pool.stats()['recycled'] == 1
+    assert pool.getconn() is not conn
+
+
+def test_read_pool_timeout(monkeypatch):
+    def query_patches(cls, sql, parameters=None):
+        raise PoolTimeout('no connection available after 0s')
+
+    monkeypatch.setattr(Session, 'query_patches', classmethod(query_patches))
+    monkeypatch.setattr(Session, 'catalog', {
+        ('public.t', 'points'): LopocsTable(
+            'public.t', 'points', 4326, 1, [], 4096, None, {})
+    })
+    monkeypatch.setattr(TileCache, 'cache', LRUCache(1024))
+    session = Session('public.t', 'points')
+    output = {'pcid': 1, 'stored': True, 'point_schema': []}
+    key = ('public.t', 'points', 1, (0, 0, 0, 1, 1, 1), 0, False)
+
+    # raised to the client (503) instead of an empty tile
+    with pytest.raises(PoolTimeout):
+        greyhound.get_cached_points(
+            key, session, [0, 0, 0, 1, 1, 1], output, 0, False)
+    assert TileCache.get(key) is None
+
+
+class FakeCursor():
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, parameters=None):
+        pass
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+def test_stream_buffer(pool, monkeypatch):
+    monkeypatch.setattr(FakeConnection, 'cursor',
+                        lambda self, name: FakeCursor([(i,) for i in range(5)]),
+                        raising=False)
+    monkeypatch.setattr(Session, 'pool', pool, raising=False)
+
+    # the result fits in the buffer: the connection is back in the pool
+    # before the first batch is yielded
+    stream = Session.stream('select', size=2, buffer=8)
+    assert next(stream) == [(0,), (1,)]
+    assert pool.stats()['in_use'] == 0
+    assert list(stream) == [[(2,), (3,)], [(4,)]]
+
+    # larger results keep the connection while the buffer is consumed
+    stream = Session.stream('select', size=2, buffer=2)
+    assert next(stream) == [(0,), (1,)]
+    assert pool.stats()['in_use'] == 1
+    assert list(stream) == [[(2,), (3,)], [(4,)]]
+    assert pool.stats()['in_use'] == 0
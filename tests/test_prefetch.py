@@ -0,0 +1,26 @@
+from lopocs.database import Session
+from lopocs.prefetch import Prefetcher
+
+
+def test_prefetcher(monkeypatch):
+    monkeypatch.setattr(Session, 'available_connections', classmethod(lambda cls: 4))
+    Prefetcher.init(1, min_connections=2)
+    done = []
+    assert Prefetcher.submit('a', done.append, 1)
+    Prefetcher.executor.shutdown(wait=True)
+    assert done == [1]
+
+    Prefetcher.hit('a')
+    Prefetcher.hit('a')
+    Prefetcher.hit('b')
+    stats = Prefetcher.stats()
+    assert stats['issued'] == 1
+    assert stats['hits'] == 1
+    assert stats['hit_ratio'] == 1
+
+
+def test_prefetcher_no_connection(monkeypatch):
+    monkeypatch.setattr(Session, 'available_connections', classmethod(lambda cls: 1))
+    Prefetcher.init(1, min_connections=2)
+    assert not Prefetcher.submit('a', print)
+    assert Prefetcher.stats()['skipped'] == 1
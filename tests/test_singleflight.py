@@ -0,0 +1,51 @@
+import time
+from threading import Event, Thread
+
+import pytest
+
+from lopocs.singleflight import SingleFlight
+
+
+def test_single_flight_coalesce():
+    flights = SingleFlight()
+    started = Event()
+    release = Event()
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        started.set()
+        release.wait()
+        return value * 2
+
+    results = []
+    leader = Thread(target=lambda: results.append(flights.do('k', compute, 21)))
+    leader.start()
+    started.wait()
+    followers = [
+        Thread(target=lambda: results.append(flights.do('k', compute, 21)))
+        for _ in range(3)
+    ]
+    for thread in followers:
+        thread.start()
+    while flights.coalesced < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert calls == [21]
+    assert results == [42] * 4
+    assert flights.stats() == {'calls': 1, 'coalesced': 3, 'inflight': 0}
+
+
+def test_single_flight_error():
+    flights = SingleFlight()
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        flights.do('k', fail)
+    # errors are not kept
+    assert flights.do('k', lambda: 1) == 1
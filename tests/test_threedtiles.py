@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+from lopocs import threedtiles
+from lopocs.conf import Config
+from lopocs.threedtiles import hierarchy_to_tileset
+
+
+def test_hierarchy_to_tileset():
+    session = SimpleNamespace(table='public.t', column='points')
+    hcy = {'n': 5, 'swd': {'n': 2}, 'neu': {'seu': {'n': 1}}}
+    tileset = hierarchy_to_tileset(
+        session, 'http://lopocs', [0, 0, 0], hcy, [0., 0., 0., 4., 4., 4.], 1, 8)
+
+    assert tileset['geometricError'] == 8
+    assert tileset['content']['url'] == (
+        'http://lopocs/3dtiles/public.t.points/read.pnts'
+        '?lod=1&bounds=[0.0,0.0,0.0,4.0,4.0,4.0]')
+    # children are ordered like OCTANTS
+    neu, swd = tileset['children']
+    assert swd['content']['url'].endswith('lod=2&bounds=[0.0,0.0,0.0,2.0,2.0,2.0]')
+    assert swd['geometricError'] == 4
+    # empty node with non-empty children
+    assert 'content' not in neu
+    assert neu['boundingVolume'] == {
+        'box': threedtiles.buildbox([2., 2., 2., 4., 4., 4.])}
+    assert neu['geometricError'] == 4
+    seu = neu['children'][0]
+    assert seu['content']['url'].endswith('lod=3&bounds=[3.0,2.0,3.0,4.0,3.0,4.0]')
+
+    # empty subtrees are dropped
+    assert hierarchy_to_tileset(
+        session, 'http://lopocs', [0, 0, 0], {'n': 0}, [0., 0., 0., 4., 4., 4.], 1, 8) == {}
+
+
+def test_build_subtileset(monkeypatch):
+    monkeypatch.setattr(Config, 'TILESET_LEVELS', 1)
+    hcy = {'n': 5, 'swd': {'n': 2}, 'neu': {}}
+    monkeypatch.setattr(threedtiles, 'tile_hierarchy', lambda *args: hcy)
+    session = SimpleNamespace(boundingbox={
+        'xmin': 0, 'ymin': 0, 'zmin': 0, 'xmax': 4, 'ymax': 4, 'zmax': 4})
+
+    tileset = threedtiles.build_subtileset(session, [0., 0., 0., 4., 4., 4.], 0)
+    root = tileset['root']
+    assert root['refine'] == 'add'
+    assert root['content']['url'] == 'read.pnts?lod=0&bounds=[0.0,0.0,0.0,4.0,4.0,4.0]'
+    # tiles of the last level point to their own tileset
+    assert [child['content']['url'] for child in root['children']] == [
+        'tileset.json?lod=1&bounds=[2.0,2.0,2.0,4.0,4.0,4.0]',
+        'tileset.json?lod=1&bounds=[0.0,0.0,0.0,2.0,2.0,2.0]',
+    ]
+    assert root['children'][0]['geometricError'] == root['geometricError'] / 2
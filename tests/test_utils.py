@@ -1,3 +1,8 @@
+from binascii import hexlify
+from struct import pack
+
+import numpy as np
+
 from lopocs import utils
 
 
@@ -29,3 +34,69 @@ def test_compute_scales_cesium():
     assert scale == 1
     scale = utils.compute_scale_for_cesium(100, 300000)
     assert scale == 1
+
+
+def test_patch_numpoints():
+    header = b'\x01' + pack('I', 1) + pack('I', 0) + pack('I', 3)
+    assert utils.patch_numpoints(hexlify(header).decode()) == 3
+    assert utils.patch_numpoints(memoryview(header)) == 3
+
+
+def test_read_uncompressed_patch():
+    schema = [
+        {'name': 'X', 'size': 4, 'type': 'signed'},
+        {'name': 'Classification', 'size': 1, 'type': 'unsigned'},
+    ]
+    header = b'\x01' + pack('I', 1) + pack('I', 0) + pack('I', 2)
+    data = pack('iB', 10, 2) + pack('iB', -5, 6)
+    for patch in (hexlify(header + data).decode(), header + data):
+        points, npoints = utils.read_uncompressed_patch(patch, schema)
+        assert npoints == 2
+        assert list(points['X']) == [10, -5]
+        assert list(points['Classification']) == [2, 6]
+
+
+def test_copy_binary_rows():
+    buf = (
+        utils.COPY_BINARY_SIGNATURE + pack('!ii', 0, 0) +
+        pack('!hi', 1, 3) + b'abc' +
+        pack('!hi', 1, -1) +
+        pack('!h', -1)
+    )
+    rows = utils.copy_binary_rows(buf)
+    assert len(rows) == 2
+    assert bytes(rows[0][0]) == b'abc'
+    assert rows[1][0] is None
+
+
+def test_transform_points():
+    schema = [
+        {'name': 'X', 'size': 4, 'type': 'signed'},
+        {'name': 'Y', 'size': 4, 'type': 'signed'},
+        {'name': 'Z', 'size': 4, 'type': 'signed'},
+        {'name': 'Intensity', 'size': 2, 'type': 'unsigned'},
+    ]
+    points = np.array(
+        [(100, 200, 300, 7)], dtype=utils.schema_dtype(schema))
+    out_schema = [
+        {'name': 'Intensity', 'size': 2, 'type': 'unsigned'},
+        {'name': 'Z', 'size': 8, 'type': 'floating'},
+        {'name': 'X', 'size': 4, 'type': 'signed'},
+        {'name': 'Classification', 'size': 1, 'type': 'unsigned'},
+    ]
+    out = utils.transform_points(
+        points, [0.01, 0.01, 0.01], [10, 20, 30],
+        out_schema, [0.1, 0.01, 0.5], [0, 20, 30])
+    assert out.dtype.names == ('Intensity', 'Z', 'X', 'Classification')
+    # X: 100 * 0.01 + 10 = 11 -> 11 / 0.1
+    assert out['X'][0] == 110
+    # Z: 300 * 0.01 + 30 = 33 -> (33 - 30) / 0.5
+    assert out['Z'][0] == 6.0
+    assert out['Intensity'][0] == 7
+    assert out['Classification'][0] == 0
+
+
+def test_pg_placeholders():
+    sql = utils.pg_placeholders("select %s from t where a = %s limit %s")
+    assert sql == "select $1 from t where a = $2 limit $3"
+    assert utils.pg_placeholders("select 1") == "select 1"